@@ -0,0 +1,43 @@
+import dataclasses
+
+import lsst.pex.config as pexConfig
+from lsst.pipe.tasks.processCcdWithFakes import (
+    ProcessCcdWithFakesConnections,
+    ProcessCcdWithFakesConfig,
+    ProcessCcdWithFakesTask,
+)
+
+from .partitionFakes import PARTITION_DIMENSIONS
+
+
+class ProcessCcdWithPartitionedFakesConnections(ProcessCcdWithFakesConnections,
+                                                dimensions=("instrument", "visit", "detector")):
+    def __init__(self, *, config=None):
+        super().__init__(config=config)
+        # load only the partitions overlapping the detector, or just the one
+        # of the detector, instead of the whole tract
+        self.fakeCats = dataclasses.replace(
+            self.fakeCats,
+            dimensions=PARTITION_DIMENSIONS[config.fakesPartition]
+        )
+
+
+class ProcessCcdWithPartitionedFakesConfig(ProcessCcdWithFakesConfig,
+                                           pipelineConnections=ProcessCcdWithPartitionedFakesConnections):
+    fakesPartition = pexConfig.ChoiceField(
+        dtype=str,
+        default="tract",
+        doc="How the fakes were partitioned, must match the partitionBy of PartitionFakesTask.",
+        allowed={
+            "tract": "One catalog per tract.",
+            "patch": "One catalog per patch of a tract.",
+            "visit": "One catalog per detector of a visit.",
+        },
+    )
+
+
+class ProcessCcdWithPartitionedFakesTask(ProcessCcdWithFakesTask):
+    """Insert fakes partitioned by PartitionFakesTask, loading only the
+    partitions of the processed detector."""
+    _DefaultName = "processCcdWithPartitionedFakes"
+    ConfigClass = ProcessCcdWithPartitionedFakesConfig
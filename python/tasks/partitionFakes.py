@@ -1,11 +1,141 @@
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+
+import lsst.geom as geom
+import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 from lsst.pipe.base import PipelineTask, PipelineTaskConfig, PipelineTaskConnections
 import lsst.pipe.base.connectionTypes as cT
 from lsst.skymap import BaseSkyMap
 import pandas as pd
-from astropy.table import vstack, Table
 import numpy as np
 
+# the only columns of the raw fakes catalogs the task uses
+FAKE_COLUMNS = ("ra", "dec", "mag", "visits")
+
+# dimensions of the partitioned catalogs, and the data ID keys
+# identifying each of them, for each of the ways to partition them
+PARTITION_DIMENSIONS = {
+    "tract": ("skymap", "tract"),
+    "patch": ("skymap", "tract", "patch"),
+    "visit": ("instrument", "visit", "detector"),
+}
+PARTITION_KEYS = {
+    "tract": ("tract", ),
+    "patch": ("tract", "patch"),
+    "visit": ("visit", "detector"),
+}
+
+
+def loadFakeColumns(deferred, columns=FAKE_COLUMNS):
+    """Load the catalog of the deferred handle and return only the given
+    columns of it, as arrays.
+
+    Only the given columns are read when the storage class of the catalog
+    takes a ``columns`` parameter, f.e. ``ArrowAstropy`` or ``DataFrame``.
+    The afw ``Catalog`` storage class, used by the recipe's ``raw_fakes``,
+    takes no parameters and is always read whole.
+    """
+    if "columns" in deferred.ref.datasetType.storageClass.parameters:
+        catalog = deferred.get(parameters={"columns": list(columns)})
+    else:
+        catalog = deferred.get()
+    if hasattr(catalog, "asAstropy"):
+        catalog = catalog.asAstropy()
+    return {name: np.asarray(catalog[name]) for name in columns}
+
+
+def concatenateColumns(loaded, columns=FAKE_COLUMNS):
+    """Concatenate the columns of all of the loaded catalogs at once."""
+    if not loaded:
+        return {name: np.array([]) for name in columns}
+    return {name: np.concatenate([cat[name] for cat in loaded]) for name in columns}
+
+
+def groupBy(keys, columns):
+    """Split the columns into groups of rows sharing the same keys with a
+    single sort of the keys.
+
+    Keys are a tuple of arrays, f.e. ``(tracts, patches)``. Yields the
+    tuple of the keys of each group and the views of the columns of its
+    rows.
+    """
+    keys = np.stack([np.asarray(key) for key in keys], axis=1)
+    if len(keys) == 0:
+        return
+    unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    order = np.argsort(inverse, kind="stable")
+    stops = np.cumsum(np.bincount(inverse, minlength=len(unique)))
+    sortedColumns = {name: column[order] for name, column in columns.items()}
+    start = 0
+    for key, stop in zip(unique, stops):
+        yield tuple(key.tolist()), {name: column[start:stop] for name, column in sortedColumns.items()}
+        start = stop
+
+
+def patchIndices(tractInfo, ra, dec):
+    """Sequential indices of the patches of the tract containing the
+    given coordinates, in degrees, computed for all of them at once."""
+    x, y = tractInfo.getWcs().skyToPixelArray(ra, dec, degrees=True)
+    bbox = tractInfo.getBBox()
+    inner = tractInfo.getPatchInnerDimensions()
+    nx, ny = tractInfo.getNumPatches()
+    ix = np.clip(np.floor((x - bbox.getMinX()) / inner.getX()), 0, nx - 1).astype(int)
+    iy = np.clip(np.floor((y - bbox.getMinY()) / inner.getY()), 0, ny - 1).astype(int)
+    return iy*nx + ix
+
+
+def detectorIndices(visitSummary, ra, dec, margin=0):
+    """Return the indices of the coordinates, in degrees, falling on any
+    of the detectors of the visit summary, grown by the margin in pixels,
+    and the IDs of those detectors.
+
+    Coordinates near the edges of the detectors may fall on more than one.
+    """
+    rows, detectors = [], []
+    for record in visitSummary:
+        wcs = record.getWcs()
+        if wcs is None:
+            continue
+        bbox = geom.Box2D(record.getBBox())
+        bbox.grow(margin)
+        x, y = wcs.skyToPixelArray(ra, dec, degrees=True)
+        inside = np.flatnonzero((x >= bbox.getMinX()) & (x <= bbox.getMaxX())
+                                & (y >= bbox.getMinY()) & (y <= bbox.getMaxY()))
+        rows.append(inside)
+        detectors.append(np.full(len(inside), record.getId()))
+    if not rows:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    return np.concatenate(rows), np.concatenate(detectors)
+
+
+def galsimFakesCatalog(fakes):
+    """Format the fakes as a catalog of stars for ProcessCcdWithFakesTask.
+
+    The unused galaxy model columns are NaN and all of the columns are
+    typed arrays, not per-row Python objects.
+    """
+    # ProcessCcdWithFakesTask uses the galsim img sim models
+    # http://galsim-developers.github.io/GalSim/_build/html/sb.html
+    # I guess it defaults to galaxy model.
+    n = len(fakes['ra'])
+    nan = np.full(n, np.nan)
+    galaxyColumns = ("bulge_semimajor", "bulge_axis_ratio", "bulge_pa", "bulge_n",
+                     "disk_semimajor", "disk_axis_ratio", "disk_pa", "disk_n",
+                     "bulge_disk_flux_ratio", "trail_length", "trail_angle")
+    catalog = dict(
+        ra=np.radians(fakes['ra']),
+        dec=np.radians(fakes['dec']),
+        **{name: nan for name in galaxyColumns},
+        select=np.ones(n, dtype=bool),
+        i_mag=fakes['mag'],
+        sourceType=pd.Categorical(np.full(n, "star")),
+        visit=fakes['visits'], # convert to visit?
+    )
+    return pd.DataFrame(catalog)
+
+
 class PartitionFakesConnections(PipelineTaskConnections, dimensions=("skymap",)):
     skyMap = cT.Input(
         doc="Skymap that defines tracts",
@@ -23,76 +153,164 @@ class PartitionFakesConnections(PipelineTaskConnections, dimensions=("skymap",))
         multiple=True,
     )
 
+    visitSummaries = cT.Input(
+        doc="Visit summaries with the WCS and the bounding box of each detector, "
+            "used to partition the fakes by visit and detector only.",
+        name="visitSummary",
+        storageClass="ExposureCatalog",
+        dimensions=("instrument", "visit"),
+        deferLoad=True,
+        multiple=True,
+    )
+
     partitionedFakes = cT.Output(
-        doc="Fakes partitioned by tract",
+        doc="Fakes partitioned by tract, by patch or by visit and detector.",
         name="partitioned_fakes",
         storageClass="DataFrame",
         dimensions=("skymap", "tract"),
         multiple=True,
     )
 
+    def __init__(self, *, config=None):
+        super().__init__(config=config)
+        self.partitionedFakes = dataclasses.replace(
+            self.partitionedFakes,
+            dimensions=PARTITION_DIMENSIONS[config.partitionBy]
+        )
+        if config.partitionBy != "visit":
+            del self.visitSummaries
+
+    def adjustQuantum(self, inputs, outputs, label, data_id):
+        """Drop the predicted partitions of the visits without a visit
+        summary, no fakes can be matched to their detectors.
+
+        Partitions by tract or by patch are not pruned, which of them get
+        fakes is only known once the catalogs are read.
+        """
+        adjustedInputs, adjustedOutputs = super().adjustQuantum(inputs, outputs, label, data_id)
+        if self.config.partitionBy == "visit":
+            _, summaryRefs = inputs["visitSummaries"]
+            visits = {ref.dataId["visit"] for ref in summaryRefs}
+            connection, refs = outputs["partitionedFakes"]
+            adjustedOutputs["partitionedFakes"] = (
+                connection,
+                [ref for ref in refs if ref.dataId["visit"] in visits]
+            )
+        return adjustedInputs, adjustedOutputs
+
+
 class PartitionFakesConfig(PipelineTaskConfig, pipelineConnections=PartitionFakesConnections):
-    pass
+    numLoadThreads = pexConfig.Field(
+        dtype=int,
+        default=4,
+        doc="Number of fake catalogs loaded concurrently, 1 loads them one at a time.",
+    )
+    partitionBy = pexConfig.ChoiceField(
+        dtype=str,
+        default="tract",
+        doc="How the fakes are partitioned. The fakes insertion task has to expect "
+            "the same partitioning, see tasks.insertFakes.",
+        allowed={
+            "tract": "One catalog per tract.",
+            "patch": "One catalog per patch of a tract.",
+            "visit": "One catalog per detector of a visit, with only the fakes of that "
+                     "visit falling on that detector. Requires the visit summaries.",
+        },
+    )
+    detectorMargin = pexConfig.Field(
+        dtype=int,
+        default=50,
+        doc="Fakes within this many pixels of a detector's edge are partitioned onto it, "
+            "when partitioning by visit and detector.",
+    )
+    writeEmpty = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc="Write an empty, zero-row, catalog for every partition without fakes, "
+            "instead of writing nothing for them.",
+    )
+
 
 class PartitionFakesTask(PipelineTask):
     _DefaultName = "partitionFakes"
     ConfigClass = PartitionFakesConfig
 
-    def run(self, skyMap, fakeCat):
-        print(skyMap)
-        print(fakeCat)
-        # determine the tract assignment of each fake based on ra/dec
+    def run(self, skyMap, fakeCat, visitSummaries=None):
+        self.log.debug("Partitioning %d fake catalogs by %s.", len(fakeCat), self.config.partitionBy)
 
-        fakes = Table()
-        for deferred in fakeCat:
-            print(dir(deferred))
-            catalog = deferred.butler.get(deferred.ref)
-            fakes = vstack([fakes, catalog.asAstropy()])
+        # load only the needed columns of each catalog and concatenate them
+        # once, instead of re-stacking everything loaded so far per catalog
+        if self.config.numLoadThreads > 1 and len(fakeCat) > 1:
+            with ThreadPoolExecutor(max_workers=self.config.numLoadThreads) as executor:
+                loaded = list(executor.map(loadFakeColumns, fakeCat))
+        else:
+            loaded = [loadFakeColumns(deferred) for deferred in fakeCat]
+        fakes = concatenateColumns(loaded)
 
-        tracts = skyMap.findTractIdArray(fakes['ra'], fakes['dec'], degrees=True)
+        partitionBy = self.config.partitionBy
+        if partitionBy == "visit":
+            keys, fakes = self.assignDetectors(fakes, visitSummaries)
+        else:
+            tracts = skyMap.findTractIdArray(fakes['ra'], fakes['dec'], degrees=True)
+            keys = (tracts, )
+            if partitionBy == "patch":
+                patches = np.zeros(len(tracts), dtype=int)
+                for (tract, ), group in groupBy(keys, {"row": np.arange(len(tracts))}):
+                    idx = group["row"]
+                    patches[idx] = patchIndices(skyMap[tract], fakes['ra'][idx], fakes['dec'][idx])
+                keys = (tracts, patches)
 
+        # outputs are keyed by the data ID values of PARTITION_KEYS
         outputCats = {}
-        for tract in set(tracts):
-            print("subsetting tract", tract)
-            subset = fakes[tracts == tract]
-            _none = [None] * len(subset)
-            _true = [True] * len(subset)
-            # ProcessCcdWithFakesTask uses the galsim img sim models
-            # http://galsim-developers.github.io/GalSim/_build/html/sb.html
-            # I guess it defaults to galaxy model.
-            outputCats[tract] = pd.DataFrame(
-                dict(
-                    ra=subset['ra'] * np.pi/180,
-                    dec=subset['dec'] * np.pi/180,
-                    bulge_semimajor=_none,
-                    bulge_axis_ratio=_none,
-                    bulge_pa=_none,
-                    bulge_n=_none,
-                    disk_semimajor=_none,
-                    disk_axis_ratio=_none,
-                    disk_pa=_none,
-                    disk_n=_none,
-                    bulge_disk_flux_ratio=_none,
-                    trail_length=_none,
-                    trail_angle=_none,
-                    select=_true,
-                    i_mag=subset['mag'],
-                    sourceType=["star"] * len(subset),
-                    visit=subset['visits'], # convert to visit?
-                )
-            )
+        for key, subset in groupBy(keys, fakes):
+            self.log.info("Partitioned %d fakes into %s", len(subset['ra']),
+                          dict(zip(PARTITION_KEYS[partitionBy], key)))
+            outputCats[key] = galsimFakesCatalog(subset)
 
         return outputCats
 
+    def assignDetectors(self, fakes, visitSummaries):
+        """Match the fakes with the detectors of their visits.
+
+        Returns the visit and the detector keys of the matched fakes and
+        their columns, fakes falling on more than one detector are repeated.
+        """
+        summaries = {handle.dataId["visit"]: handle for handle in visitSummaries or []}
+        rows, visits, detectors = [], [], []
+        for (visit, ), group in groupBy((fakes['visits'], ), {"row": np.arange(len(fakes['visits']))}):
+            idx = group["row"]
+            if visit not in summaries:
+                self.log.warning("No visit summary for visit %d, dropping its %d fakes.", visit, len(idx))
+                continue
+            inside, ids = detectorIndices(summaries[visit].get(), fakes['ra'][idx], fakes['dec'][idx],
+                                          self.config.detectorMargin)
+            rows.append(idx[inside])
+            visits.append(np.full(len(inside), visit))
+            detectors.append(ids)
+
+        if not rows:
+            return (np.array([], dtype=int), np.array([], dtype=int)), {k: v[:0] for k, v in fakes.items()}
+        rows = np.concatenate(rows)
+        return (np.concatenate(visits), np.concatenate(detectors)), {k: v[rows] for k, v in fakes.items()}
+
     def runQuantum(self, butlerQC, inputRefs, outputRefs):
         inputs = butlerQC.get(inputRefs)
 
-        print("inputs=", inputs)
-        print("outputRefs")
-        print(outputRefs) # all of the tracts in the skymap
-
         runOutputs = self.run(**inputs)
-        if runOutputs:
-            tracts = [ref.dataId['tract'] for ref in outputRefs.partitionedFakes]
-            outputs = [runOutputs.get(tract, pd.DataFrame()) for tract in tracts] # trim outputs to just those
-            butlerQC.put(pipeBase.Struct(partitionedFakes=outputs), outputRefs)
+        if not runOutputs:
+            raise pipeBase.NoWorkFound("None of the fakes could be partitioned.")
+
+        # outputs are predicted for all of the partitions, f.e. all of the
+        # tracts in the skymap, but only the populated ones are written; the
+        # quanta reading the rest find no inputs and are skipped. Only the
+        # partitions by visit are pruned beforehand, see adjustQuantum
+        keys = PARTITION_KEYS[self.config.partitionBy]
+        empty = galsimFakesCatalog(concatenateColumns([]))
+        written = 0
+        for ref in outputRefs.partitionedFakes:
+            catalog = runOutputs.get(tuple(ref.dataId[k] for k in keys))
+            if catalog is None and not self.config.writeEmpty:
+                continue
+            butlerQC.put(empty if catalog is None else catalog, ref)
+            written += 1
+        self.log.info("Wrote %d of %d predicted partitions.", written, len(outputRefs.partitionedFakes))
@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+import os
+import glob
+import json
+import argparse
+import itertools
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from recipe_utils import read_fits_headers, radec2vec, vec2radec
+
+
+############################################################
+#                         Utils
+############################################################
+# Gaussian gravitational constant, radians per day at 1 AU
+GAUSS_K = 0.01720209895
+# speed of light in AU per day
+C_AU_PER_DAY = 173.1446326846693
+# obliquity of the ecliptic at J2000, degrees
+OBLIQUITY = 23.4392911
+
+# a population of moving objects; any of the keys can be overridden
+DEFAULT_POPULATION = {
+    "name": "population",
+    # number of objects per pointing
+    "n": 100,
+    # linear or orbit
+    "motion": "linear",
+    # uniform range of magnitudes
+    "mag": [20.0, 24.0],
+    # linear: uniform range of on-sky speeds, arcsec per hour, and of the
+    # position angles of the motion, degrees east of north
+    "speed": [1.0, 5.0],
+    "angle": [0.0, 360.0],
+    # orbit: uniform range of heliocentric distances, AU, of the circular
+    # orbits and the maximal tilt, degrees, of the orbits to the ecliptic
+    "distance": [30.0, 50.0],
+    "inclination": 10.0,
+}
+
+
+def make_wcs(header):
+    """Return the `astropy.wcs.WCS` of the header keyword-value dict."""
+    from astropy.io import fits
+    from astropy.wcs import WCS, FITSFixedWarning
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FITSFixedWarning)
+        return WCS(fits.Header(header))
+
+
+def tangent_directions(vec):
+    """East and north unit vectors tangent to the sphere at the given unit
+    vectors."""
+    north = np.array([0.0, 0.0, 1.0])
+    east = np.cross(north, vec)
+    east /= np.linalg.norm(east, axis=-1, keepdims=True)
+    return east, np.cross(vec, east)
+
+
+def read_exposure(fitsPath, detectors=None):
+    """Read the exposure metadata and the detector headers, and nothing
+    else, of the FITS file.
+
+    Parameters
+    ----------
+    fitsPath : `str`
+        Path to the FITS file.
+    detectors : `list` or `None`
+        HDU indices of the detectors to read. When `None` reads all of the
+        image-like HDUs with a celestial WCS.
+
+    Returns
+    -------
+    exposure : `dict`
+        The path, visit (``EXPNUM``), pointing (``OBJECT``), the MJD of the
+        middle of the exposure and the headers of the detectors.
+    """
+    hdus = None if detectors is None else [0] + list(detectors)
+    headers = read_fits_headers(fitsPath, hdus)
+    primary = headers.pop(0)
+    return {
+        "path": fitsPath,
+        "visit": primary["EXPNUM"],
+        "pointing": primary.get("OBJECT", ""),
+        "mjd": primary["MJD-OBS"] + primary.get("EXPTIME", 0) / 2 / 86400,
+        "detectors": {
+            hdu: hdr for hdu, hdr in headers.items()
+            if "CRVAL1" in hdr and hdr.get("NAXIS", 0) == 2
+        },
+    }
+
+
+############################################################
+#                       Populations
+############################################################
+def sample_positions(exposure, n, rng):
+    """Sample positions uniformly on the detectors of the exposure.
+
+    Pixel positions are drawn for all of the objects at once and then
+    converted with one ``pixel_to_world`` call per detector.
+
+    Returns
+    -------
+    ra, dec : `np.array`
+        Coordinates, in degrees.
+    """
+    hdus = np.array(sorted(exposure["detectors"]))
+    areas = np.array([exposure["detectors"][h]["NAXIS1"] * exposure["detectors"][h]["NAXIS2"] for h in hdus])
+    onDetector = rng.choice(len(hdus), size=n, p=areas/areas.sum())
+
+    ra, dec = np.zeros(n), np.zeros(n)
+    for i, hdu in enumerate(hdus):
+        mask = onDetector == i
+        if not mask.any():
+            continue
+        hdr = exposure["detectors"][hdu]
+        x = rng.uniform(-0.5, hdr["NAXIS1"] - 0.5, mask.sum())
+        y = rng.uniform(-0.5, hdr["NAXIS2"] - 0.5, mask.sum())
+        ra[mask], dec[mask] = make_wcs(hdr).pixel_to_world_values(x, y)
+    return ra, dec
+
+
+def earth_positions(mjd):
+    """Heliocentric positions of the Earth, in AU and ICRS axes, at the
+    given UTC MJDs."""
+    from astropy.time import Time
+    from astropy.coordinates import get_body_barycentric
+
+    times = Time(mjd, format="mjd", scale="utc")
+    earth = get_body_barycentric("earth", times) - get_body_barycentric("sun", times)
+    return earth.xyz.to_value("AU").T
+
+
+def make_population(population, ra, dec, mjd0, rng):
+    """Draw the parameters of the objects of the population starting at
+    the given coordinates at the given time.
+
+    Linear objects move along great circles at constant speeds. Orbit
+    objects move on circular heliocentric orbits, observed from the center
+    of the Earth, so they also show the parallax due to the Earth's motion.
+
+    Parameters
+    ----------
+    population : `dict`
+        Population, see `DEFAULT_POPULATION`.
+    ra, dec : `np.array`
+        Coordinates of the objects at the reference time, in degrees.
+    mjd0 : `float`
+        Reference time, UTC MJD.
+    rng : `np.random.Generator`
+        Random number generator.
+
+    Returns
+    -------
+    objects : `dict`
+        Arrays of the parameters of the objects, see `object_positions`.
+    """
+    n = len(ra)
+    start = radec2vec(ra, dec)
+    objects = {
+        "motion": population["motion"],
+        "mjd0": np.full(n, mjd0),
+        "mag": rng.uniform(*population["mag"], n),
+    }
+
+    if population["motion"] == "linear":
+        speed = np.radians(rng.uniform(*population["speed"], n) / 3600) * 24
+        angle = np.radians(rng.uniform(*population["angle"], n))
+        east, north = tangent_directions(start)
+        objects["start"] = start
+        objects["velocity"] = speed[:, None] * (np.sin(angle)[:, None]*east + np.cos(angle)[:, None]*north)
+    elif population["motion"] == "orbit":
+        # place the objects along the lines of sight at the drawn distances
+        earth = earth_positions(mjd0)
+        distance = rng.uniform(*population["distance"], n)
+        if np.any(distance <= np.linalg.norm(earth)):
+            raise ValueError("Orbit distances must be larger than 1 AU.")
+        proj = start @ earth
+        delta = -proj + np.sqrt(proj**2 - earth @ earth + distance**2)
+        radial = (earth + delta[:, None]*start) / distance[:, None]
+
+        # orbit normals tilted away from the ecliptic pole, prograde orbits
+        eps = np.radians(OBLIQUITY)
+        pole = np.array([0.0, -np.sin(eps), np.cos(eps)])
+        normal = pole - (radial @ pole)[:, None]*radial
+        normal /= np.linalg.norm(normal, axis=-1, keepdims=True)
+        tilt = np.radians(rng.uniform(-population["inclination"], population["inclination"], n))
+        normal = np.cos(tilt)[:, None]*normal + np.sin(tilt)[:, None]*np.cross(radial, normal)
+
+        objects["distance"] = distance
+        objects["radial"] = radial
+        objects["tangential"] = np.cross(normal, radial)
+        objects["rate"] = GAUSS_K / distance**1.5
+    else:
+        raise ValueError(f"Unknown motion {population['motion']}, expected linear or orbit.")
+
+    return objects
+
+
+def object_positions(objects, mjd):
+    """Coordinates of the objects at the given time.
+
+    Parameters
+    ----------
+    objects : `dict`
+        Objects, see `make_population`.
+    mjd : `float`
+        Time, UTC MJD.
+
+    Returns
+    -------
+    ra, dec : `np.array`
+        Coordinates, in degrees.
+    """
+    dt = mjd - objects["mjd0"]
+    if objects["motion"] == "linear":
+        moved = objects["start"] + dt[:, None]*objects["velocity"]
+        return vec2radec(moved / np.linalg.norm(moved, axis=-1, keepdims=True))
+
+    earth = earth_positions(mjd)
+    geocentric = None
+    lightTime = 0
+    # one light-time iteration is plenty for the solar system distances
+    for _ in range(2):
+        phase = objects["rate"] * (dt - lightTime)
+        helio = objects["distance"][:, None] * (np.cos(phase)[:, None]*objects["radial"]
+                                                + np.sin(phase)[:, None]*objects["tangential"])
+        geocentric = helio - earth
+        lightTime = np.linalg.norm(geocentric, axis=-1) / C_AU_PER_DAY
+    geocentric /= np.linalg.norm(geocentric, axis=-1, keepdims=True)
+    return vec2radec(geocentric)
+
+
+def observe(exposure, objects):
+    """Find the objects falling on the detectors of the exposure.
+
+    Sky positions are converted with one ``world_to_pixel`` call per
+    detector for all of the objects at once.
+
+    Returns
+    -------
+    rows : `dict`
+        Columns of the observed objects: their ``id``, ``ra`` and ``dec`` in
+        degrees, ``mag``, ``visits``, ``mjd``, ``detector``, the HDU index,
+        and ``x`` and ``y``, their zero-based pixel coordinates.
+    """
+    ra, dec = object_positions(objects, exposure["mjd"])
+    columns = {k: [] for k in ("id", "ra", "dec", "mag", "detector", "x", "y")}
+    for hdu, hdr in exposure["detectors"].items():
+        x, y = make_wcs(hdr).world_to_pixel_values(ra, dec)
+        inside = np.flatnonzero((x >= -0.5) & (x < hdr["NAXIS1"] - 0.5)
+                                & (y >= -0.5) & (y < hdr["NAXIS2"] - 0.5))
+        for name, values in (("id", objects["id"]), ("ra", ra), ("dec", dec), ("mag", objects["mag"]),
+                             ("x", x), ("y", y)):
+            columns[name].append(values[inside])
+        columns["detector"].append(np.full(len(inside), hdu))
+
+    rows = {k: np.concatenate(v) if v else np.array([]) for k, v in columns.items()}
+    rows["visits"] = np.full(len(rows["id"]), exposure["visit"])
+    rows["mjd"] = np.full(len(rows["id"]), exposure["mjd"])
+    return rows
+
+
+def _observe_populations(exposure, populations):
+    """Observe every population, tagged by their indices, in one task."""
+    observed = []
+    for i, objects in enumerate(populations):
+        rows = observe(exposure, objects)
+        rows["population"] = np.full(len(rows["id"]), i)
+        observed.append(rows)
+    return observed
+
+
+############################################################
+#                         Main
+############################################################
+def generate_fakes(fitsPaths, populations, detectors=None, jobs=1, seed=None):
+    """Generate catalogs of moving fake objects as seen by the exposures.
+
+    Exposures are grouped by their pointings. For each pointing every
+    population places its objects uniformly on the detectors of the
+    earliest exposure, which they then move away from. Only the headers of
+    the files are read and both the reading and the observations are split
+    between ``jobs`` worker processes.
+
+    Parameters
+    ----------
+    fitsPaths : `list`
+        Paths to the FITS files.
+    populations : `list`
+        Populations of the objects, see `DEFAULT_POPULATION`.
+    detectors : `list` or `None`
+        HDU indices of the detectors objects are placed on and observed by.
+        When `None` uses all of the image-like HDUs.
+    jobs : `int`
+        Number of worker processes. Default: 1.
+    seed : `int` or `None`
+        Seed of the random number generator.
+
+    Returns
+    -------
+    catalog : `astropy.table.Table`
+        Observations of the objects, one row per object per exposure it
+        falls on, with the ``population`` name, ``id``, ``ra``, ``dec``,
+        ``mag``, ``visits``, ``mjd``, ``detector``, ``x``, ``y`` and
+        ``sourceType`` columns.
+    """
+    from astropy.table import Table
+
+    rng = np.random.default_rng(seed)
+    populations = [dict(DEFAULT_POPULATION, **p) for p in populations]
+
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+        mapper = pool.map if jobs > 1 else map
+        exposures = list(mapper(read_exposure, fitsPaths, itertools.repeat(detectors)))
+
+        pointings = {}
+        for exposure in sorted(exposures, key=lambda e: e["mjd"]):
+            pointings.setdefault(exposure["pointing"], []).append(exposure)
+
+        objects, nextId = [], 0
+        for population in populations:
+            parts = []
+            for group in pointings.values():
+                ra, dec = sample_positions(group[0], population["n"], rng)
+                parts.append(make_population(population, ra, dec, group[0]["mjd"], rng))
+            merged = {"motion": population["motion"]}
+            for key in parts[0] if parts else []:
+                if key != "motion":
+                    merged[key] = np.concatenate([p[key] for p in parts])
+            merged["id"] = nextId + np.arange(len(merged.get("mag", [])))
+            nextId += len(merged["id"])
+            objects.append(merged)
+
+        observed = list(mapper(_observe_populations, exposures, itertools.repeat(objects)))
+
+    rows = [r for perExposure in observed for r in perExposure]
+    names = [p["name"] for p in populations]
+    catalog = Table({
+        "population": np.array(names)[np.concatenate([r["population"] for r in rows]).astype(int)]
+                      if rows else np.array([], dtype=str),
+        **{k: np.concatenate([r[k] for r in rows]) if rows else np.array([])
+           for k in ("id", "ra", "dec", "mag", "visits", "mjd", "detector", "x", "y")}
+    })
+    for k in ("id", "visits", "detector"):
+        catalog[k] = catalog[k].astype(int)
+    # all of the fakes are point sources, see ProcessCcdWithFakesTask
+    catalog["sourceType"] = np.full(len(catalog), "star")
+    return catalog
+
+
+def write_catalog(catalog, writeto, overwrite=False):
+    """Write the catalog as a FITS table or, for the ``.parquet`` files, as
+    a Parquet table, which requires ``pyarrow``."""
+    if writeto.endswith(".parquet"):
+        catalog.write(writeto, format="parquet", overwrite=overwrite)
+    else:
+        catalog.write(writeto, format="fits", overwrite=overwrite)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Generate catalogs of moving fake objects, on linear or circular orbit "
+            "trajectories, as seen by the given exposures. Only the FITS headers are read."
+        )
+    )
+
+    parser.add_argument(
+        "path",
+        help="Path to an image or a directory of images."
+    )
+    parser.add_argument(
+        "writeto",
+        help="Path to the output catalog, a .fits or a .parquet file."
+    )
+
+    parser.add_argument(
+        "--detectors",
+        help="HDU indices of the detectors to place the objects on. Default: all of them",
+        nargs="?", default=None, dest="detectors"
+    )
+    parser.add_argument(
+        "--populations",
+        help=(
+            "Path to a JSON file with a list of populations, keys of which override "
+            "the values given by the arguments below."
+        ),
+        nargs="?", default=None, dest="populations"
+    )
+    parser.add_argument(
+        "--n-objects",
+        help=f"Number of objects per pointing. Default: {DEFAULT_POPULATION['n']}",
+        nargs="?", default=DEFAULT_POPULATION["n"], type=int, dest="n"
+    )
+    parser.add_argument(
+        "--motion",
+        help="Motion of the objects: linear or orbit. Default: linear",
+        choices=("linear", "orbit"), default="linear", dest="motion"
+    )
+    parser.add_argument(
+        "--mag",
+        help="Range of the magnitudes. Default: 20 24",
+        nargs=2, type=float, default=DEFAULT_POPULATION["mag"], dest="mag"
+    )
+    parser.add_argument(
+        "--speed",
+        help="Range of the speeds of linear motion, arcsec per hour. Default: 1 5",
+        nargs=2, type=float, default=DEFAULT_POPULATION["speed"], dest="speed"
+    )
+    parser.add_argument(
+        "--angle",
+        help="Range of the directions of linear motion, degrees east of north. Default: 0 360",
+        nargs=2, type=float, default=DEFAULT_POPULATION["angle"], dest="angle"
+    )
+    parser.add_argument(
+        "--distance",
+        help="Range of the heliocentric distances of orbits, AU. Default: 30 50",
+        nargs=2, type=float, default=DEFAULT_POPULATION["distance"], dest="distance"
+    )
+    parser.add_argument(
+        "--inclination",
+        help="Maximal tilt of the orbits to the ecliptic, degrees. Default: 10",
+        nargs="?", type=float, default=DEFAULT_POPULATION["inclination"], dest="inclination"
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed of the random number generator.",
+        nargs="?", type=int, default=None, dest="seed"
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        help="Number of worker processes the files are split between. Default: 1",
+        type=int, default=1, dest="jobs"
+    )
+    parser.add_argument(
+        "--ingest-file",
+        help=(
+            "Also write a CSV file listing the catalog, with a {ROOT} placeholder, "
+            "to be ingested into the butler as raw_fakes."
+        ),
+        nargs="?", default=None, dest="ingestFile"
+    )
+    parser.add_argument(
+        "--overwrite",
+        help="Overwrite the catalog if it exists.",
+        action="store_true", dest="overwrite"
+    )
+
+    aargs = parser.parse_args()
+
+    if os.path.isfile(aargs.path):
+        files = [aargs.path, ]
+    elif os.path.isdir(aargs.path):
+        files = sorted(glob.glob(f"{aargs.path}/*.fits*"))
+    else:
+        raise ValueError(f"Expected path to file or a directory, got {aargs.path} instead.")
+
+    detectors = None
+    if aargs.detectors is not None:
+        detectors = [int(i) for i in aargs.detectors.replace(",", " ").split()]
+
+    base = {k: getattr(aargs, k) for k in ("n", "motion", "mag", "speed", "angle", "distance", "inclination")}
+    if aargs.populations is not None:
+        with open(aargs.populations) as f:
+            populations = [dict(base, **p) for p in json.load(f)]
+    else:
+        populations = [base, ]
+
+    catalog = generate_fakes(files, populations, detectors=detectors, jobs=aargs.jobs, seed=aargs.seed)
+    write_catalog(catalog, aargs.writeto, overwrite=aargs.overwrite)
+    print(f"Wrote {len(catalog)} observations of {len(np.unique(catalog['id'])) if len(catalog) else 0} "
+          f"objects in {len(files)} exposures to {aargs.writeto}.")
+
+    if aargs.ingestFile:
+        with open(aargs.ingestFile, "w") as f:
+            f.write("file\n")
+            f.write(f"{{ROOT}}/{os.path.basename(aargs.writeto)}\n")
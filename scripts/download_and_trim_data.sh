@@ -1,10 +1,15 @@
 #!/bin/bash
 
-# Download calibs and science data to rawData dir
+# Download science data to rawData dir, trimming each exposure into the
+# trimmedRawData dir as soon as it is downloaded
 python scripts/download_data.py \
     --download-science rawData/210318/science/ \
-    --filters i
+    --filters i \
+    --trim-to trimmedRawData --trim-hdus 35 --trim-incremental --trim-overwrite
 
-cp -r rawData trimmedRawData
-scripts/trim_ccds.py trimmedRawData/210318/science 35 --verbose --overwrite
-scripts/trim_ccds.py trimmedRawData/210318/calib/bias 35 --verbose --overwrite
+# Trim the previously downloaded biases, if any, without copying them
+if [ -d rawData/210318/calib/bias ]; then
+    mkdir -p trimmedRawData/210318/calib/bias
+    scripts/trim_ccds.py rawData/210318/calib/bias 35 --writeto trimmedRawData/210318/calib/bias \
+        --verbose --overwrite --incremental
+fi
@@ -1,7 +1,16 @@
 #!/usr/bin/env python3
 import os
+import json
+import time
+import datetime
+import hashlib
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 try:
     # this makes sense because mostly the script would
     # be used with an activate lsst env.
@@ -10,6 +19,58 @@ except ImportError:
     tabulate = None
 
 
+class CachedResponse:
+    # Stand-in for the `requests.Response` of an archive query read from
+    # the cache, provides just what the Downloader needs.
+    def __init__(self, jdat, status_code=200, reason="OK"):
+        self.jdat = jdat
+        self.status_code = status_code
+        self.reason = reason
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self.jdat
+
+
+class QueryCache:
+    # On-disk cache of the archive query results, keyed by the query URL
+    # and the payload. Results older than `ttl` seconds are queried again.
+    def __init__(self, dirpath=None, ttl=86400):
+        if dirpath is None:
+            cacheHome = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+            dirpath = os.path.join(cacheHome, "kbmod_imdiff_recipe", "queries")
+        self.dirpath = dirpath
+        self.ttl = ttl
+
+    def path(self, url, payload):
+        key = json.dumps([url, payload], sort_keys=True)
+        return os.path.join(self.dirpath, hashlib.md5(key.encode()).hexdigest() + ".json")
+
+    def get(self, url, payload):
+        fpath = self.path(url, payload)
+        try:
+            if time.time() - os.path.getmtime(fpath) > self.ttl:
+                return None
+            with open(fpath) as f:
+                return CachedResponse(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url, payload, response):
+        # only successful queries are cached
+        if not response.ok:
+            return
+        os.makedirs(self.dirpath, exist_ok=True)
+        fpath = self.path(url, payload)
+        tmppath = f"{fpath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmppath, "w") as f:
+            json.dump(response.json(), f)
+        os.replace(tmppath, fpath)
+
+
 class Downloader:
     # See https://github.com/NOAO/nat-nb/blob/master/advanced-search.ipynb
     # for all field details, this Factory only creates minimum required for
@@ -33,8 +94,15 @@ class Downloader:
         "ifilter",
     ]
     outfields_v0 = [outfields_v2[:2], ]
+    # used by the DownloadPlan to estimate the download size
+    outfields_v3 = outfields_v2 + ["filesize", ]
     query_url = "https://astroarchive.noirlab.edu/api/adv_search/find/?"
     download_url = "https://astroarchive.noirlab.edu/api/retrieve/{}"
+    # size of the chunks streamed to disk
+    chunk_size = 2**20
+    # `QueryCache` of the archive queries, or `None` to always query,
+    # enabled by the command line interface only
+    cache = None
 
     def __init__(self, response):
         self.response = [response,]
@@ -52,17 +120,42 @@ class Downloader:
             )
 
         self.query_params = [jdat[0], ]
-        self.jdat = jdat[1:]
-        
-        # empty list, no matched results
-        if not self.jdat:
+        rows = jdat[1:]
+
+        # results are stored column-wise, as a list of chunks, one per
+        # query, that are joined only when the columns are accessed
+        if not rows:
             self.header = []
-            self.data = []
+            self._chunks = []
         else:
-            self.header = self.jdat[0].keys()
-            self.data = []
-            for row in self.jdat:
-                self.data.append([row[key] for key in self.header])
+            self.header = list(rows[0].keys())
+            self._chunks = [{key: np.array([row[key] for row in rows]) for key in self.header}]
+
+    @classmethod
+    def fromColumns(cls, columns, response=None, query_params=None):
+        obj = cls.__new__(cls)
+        obj.response = [] if response is None else list(response)
+        obj.query_params = [] if query_params is None else list(query_params)
+        obj.header = list(columns.keys())
+        obj._chunks = [dict(columns)] if obj.header else []
+        return obj
+
+    @property
+    def columns(self):
+        if len(self._chunks) > 1:
+            self._chunks = [{
+                key: np.concatenate([chunk[key] for chunk in self._chunks])
+                for key in self.header
+            }]
+        return self._chunks[0] if self._chunks else {}
+
+    @property
+    def data(self):
+        # row-wise view of the results, for display
+        return [list(row) for row in zip(*[col.tolist() for col in self.columns.values()])]
+
+    def __len__(self):
+        return sum(len(chunk[self.header[0]]) for chunk in self._chunks) if self.header else 0
 
     @classmethod
     def getPayload(cls, archivefilename, obstype, additionalArgs=None, verbosity=0):
@@ -86,11 +179,58 @@ class Downloader:
         }
         return base_yaml
 
+    @classmethod
+    def query(cls, payload, session=None):
+        if cls.cache is not None:
+            response = cls.cache.get(cls.query_url, payload)
+            if response is not None:
+                return response
+
+        session = requests if session is None else session
+        response = session.post(cls.query_url, json=payload, timeout=300)
+        if cls.cache is not None:
+            cls.cache.put(cls.query_url, payload, response)
+        return response
+
     @classmethod
     def get(cls, archivefilename, obstype, additionalArgs=None, verbosity=0):
         payload = cls.getPayload(archivefilename, obstype, additionalArgs, verbosity)
-        results = requests.post(cls.query_url, json=payload)
-        return cls(results)
+        return cls(cls.query(payload))
+
+    @classmethod
+    def _queryMany(cls, queries, verbosity=0, jobs=4):
+        # The adv_search endpoint evaluates a single conjunctive search per
+        # request, so each (archivefilename, obstype, additionalArgs) query
+        # costs a request. Duplicated queries are requested once, the rest
+        # concurrently. Returns the payload keys and the responses by key.
+        keys, unique = [], {}
+        for query in queries:
+            payload = cls.getPayload(*query, verbosity=verbosity)
+            keys.append(json.dumps(payload, sort_keys=True))
+            unique[keys[-1]] = payload
+
+        with cls.makeSession(jobs) as session, ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            responses = dict(zip(
+                unique.keys(),
+                executor.map(lambda payload: cls.query(payload, session), unique.values())
+            ))
+        return keys, responses
+
+    @classmethod
+    def getEach(cls, queries, verbosity=0, jobs=4):
+        # one Downloader per query, in the order of `queries`
+        keys, responses = cls._queryMany(queries, verbosity, jobs)
+        return [cls(responses[key]) for key in keys]
+
+    @classmethod
+    def getMany(cls, queries, verbosity=0, jobs=4):
+        # results of all the queries, joined in the order of `queries`
+        keys, responses = cls._queryMany(queries, verbosity, jobs)
+        keys = list(dict.fromkeys(keys))
+        results = cls(responses[keys[0]])
+        for key in keys[1:]:
+            results.extend(cls(responses[key]))
+        return results
 
     def __str__(self):
         if tabulate is not None:
@@ -100,49 +240,306 @@ class Downloader:
             tmplt = "".join(["{{:{0}}}".format(pad+2) for pad in padding]) + "\n"
             retr = tmplt.format(*self.header)
             for row in self.data:
-                retr += tmplt.format(*row)
+                retr += tmplt.format(*[str(val) for val in row])
             return retr
 
     def extend(self, other):
         # header check prevents `self` from being empty 
         if not self.header and other.header:
-            self.header = other.header 
+            self.header = list(other.header)
 
-        if not self.header and self.header != other.header:
+        if self.header and other.header and self.header != list(other.header):
             raise ValueError("Unable to extend Downloaders with unmatched headers.")
 
         self.response.extend(other.response)
-        self.query_params.append(other.query_params)
-        self.jdat.extend(other.jdat)
-        self.data.extend(other.data)
-        
+        self.query_params.extend(other.query_params)
+        self._chunks.extend(other._chunks)
+
     def get_column(self, name):
         if not self.header:
-            return []
+            return np.array([])
 
         if name not in self.header:
             raise ValueError(f"Key '{name}' not availible in the data. Are you sure it's spelled right?")
-            
-        idx = list(self.header).index(name)
-        res = []
-        for row in self.data:
-            res.append(row[idx])
-        return res
-
-    def downloadTo(self, dirpath):
+
+        return self.columns[name]
+
+    def select(self, mask):
+        # new Downloader with the rows selected by the boolean mask or indices
+        columns = {key: col[mask] for key, col in self.columns.items()}
+        return self.fromColumns(columns, self.response, self.query_params)
+
+    def filter(self, ifilter=None, proposal=None, obstype=None, dateRange=None,
+               raRange=None, decRange=None):
+        # Select rows matching all of the given values, or lists of values,
+        # of the filter, proposal and observation type. The inclusive
+        # (min, max) date range compares ISO caldat strings, the RA, Dec
+        # ranges compare ra_min, dec_min in degrees.
+        mask = np.ones(len(self), dtype=bool)
+        for name, values in (("ifilter", ifilter), ("proposal", proposal), ("obs_type", obstype)):
+            if values is not None:
+                values = [values] if isinstance(values, str) else list(values)
+                mask &= np.isin(self.get_column(name), values)
+
+        for name, valrange in (("caldat", dateRange), ("ra_min", raRange), ("dec_min", decRange)):
+            if valrange is not None:
+                col = self.get_column(name)
+                if name == "caldat":
+                    col = col.astype(str)
+                elif col.dtype == object:
+                    # positions are missing for some calibrations
+                    col = np.array([np.nan if val is None else val for val in col], dtype=float)
+                lo, hi = valrange
+                if lo is not None:
+                    mask &= col >= lo
+                if hi is not None:
+                    mask &= col <= hi
+
+        return self.select(mask)
+
+    @staticmethod
+    def makeSession(connections=4):
+        # one pooled session shared by all the download threads, with
+        # enough connections kept alive that no thread waits on the pool
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @classmethod
+    def fileMd5(cls, fpath, hasher=None):
+        hasher = hashlib.md5() if hasher is None else hasher
+        with open(fpath, "rb") as f:
+            for chunk in iter(lambda: f.read(cls.chunk_size), b""):
+                hasher.update(chunk)
+        return hasher
+
+    def _download(self, session, md5, fpath, label, report):
+        # verified files are never downloaded again
+        if os.path.exists(fpath):
+            if self.fileMd5(fpath).hexdigest() == md5:
+                report(f"{label} Already present, verified.")
+                return 0
+            report(f"{label} Present but checksum does not match, downloading again.")
+
+        # downloads go to a part file that is resumed, with a HTTP range
+        # request, if a previous download was interrupted
+        part = f"{fpath}.part"
+        hasher, offset = hashlib.md5(), 0
+        if os.path.exists(part):
+            self.fileMd5(part, hasher)
+            offset = os.path.getsize(part)
+
+        start = time.time()
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with session.get(self.download_url.format(md5), headers=headers,
+                         stream=True, timeout=60) as response:
+            # the part file is already complete
+            if response.status_code == 416:
+                response = None
+            # the server ignored the range, start from scratch
+            elif response.status_code != 206 and offset:
+                response.raise_for_status()
+                hasher, offset = hashlib.md5(), 0
+                report(f"{label} Server can not resume, downloading from start.")
+            elif offset:
+                report(f"{label} Resuming from {offset/2**20:.1f} MB.")
+
+            done, nextReport = offset, 0.25
+            if response is not None:
+                response.raise_for_status()
+                total = offset + int(response.headers.get("Content-Length", 0))
+                with open(part, "ab" if offset else "wb") as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        done += len(chunk)
+                        if total and done/total >= nextReport and done < total:
+                            report(f"{label} {100*done/total:3.0f}% ({done/2**20:.1f}/{total/2**20:.1f} MB)")
+                            nextReport = (int(4*done/total) + 1)/4
+
+        if hasher.hexdigest() != md5:
+            # a corrupted part can't be resumed, remove it
+            os.remove(part)
+            raise ValueError(f"Checksum {hasher.hexdigest()} does not match the archive md5sum {md5}.")
+        os.replace(part, fpath)
+
+        elapsed = max(time.time() - start, 1e-6)
+        report(f"{label} Success, {(done-offset)/2**20:.1f} MB at {(done-offset)/2**20/elapsed:.1f} MB/s.")
+        return done - offset
+
+    def downloadTo(self, dirpath, jobs=4, onComplete=None):
+        # `onComplete` is called with the path of each downloaded, or
+        # already present, file as soon as it is verified. Its errors are
+        # reported as failures, they do not interrupt the other downloads.
         ids = self.get_column("md5sum")
         names = [os.path.basename(aname) for aname in self.get_column("archive_filename")]
-        i, tot = 0, len(ids)
-        for md5, name in zip(ids, names):
-            print(f"[{i:3}/{tot:3}] Downloading {name}")
-            response = requests.get(self.download_url.format(md5))
-            if response.ok:
-                with open(os.path.join(dirpath, name), "wb") as f:
-                    f.write(response.content)
-                print("    Success.")
-            else:
-                print("    FAILED.")
-            i += 1
+        tot = len(ids)
+        jobs = max(1, int(jobs))
+
+        lock = threading.Lock()
+        def report(msg):
+            with lock:
+                print(msg, flush=True)
+
+        session = self.makeSession(jobs)
+        failed = []
+        with session, ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for i, (md5, name) in enumerate(zip(ids, names)):
+                label = f"[{i:3}/{tot:3}] {name}"
+                future = executor.submit(
+                    self._download, session, md5, os.path.join(dirpath, name), label, report
+                )
+                futures[future] = (label, os.path.join(dirpath, name))
+            for future in as_completed(futures):
+                label, fpath = futures[future]
+                try:
+                    future.result()
+                except (requests.RequestException, OSError, ValueError) as e:
+                    report(f"{label} FAILED: {e}")
+                    failed.append(label)
+                else:
+                    if onComplete is None:
+                        continue
+                    try:
+                        onComplete(fpath)
+                    except (RuntimeError, OSError, ValueError) as e:
+                        report(f"{label} FAILED after download: {e}")
+                        failed.append(label)
+
+        return failed
+
+
+class DownloadPlan:
+    # Deduplicated list of the bias, flat and science raws of a range of
+    # nights, that can be written to, and run from, a JSON plan file. Each
+    # file is downloaded to `root/YYMMDD/calib/bias`, `.../calib/flat` or
+    # `.../science` directory of the night it was taken on, its caldat.
+    columns = ["md5sum", "archive_filename", "caldat", "ifilter", "proposal", "filesize", "subdir"]
+
+    def __init__(self, files, root="rawData", queries=None):
+        self.files = files
+        self.root = root
+        self.queries = [] if queries is None else queries
+
+    @staticmethod
+    def nights(start, end):
+        start = datetime.date.fromisoformat(str(start))
+        end = datetime.date.fromisoformat(str(end))
+        return [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+
+    @classmethod
+    def makeQueries(cls, start, end, filters, proposals=None):
+        # DECam file names carry the UT date, and a night spans two UT
+        # dates, so every date of the range and the day after it is
+        # searched once. The files are assigned to the nights afterwards.
+        end = datetime.date.fromisoformat(str(end)) + datetime.timedelta(days=1)
+        queries = []
+        for day in cls.nights(start, end):
+            prefix = f"c4d_{day:%y%m%d}"
+            queries.append(("calib/bias", (prefix, "zero", None)))
+            for filter_name in filters:
+                queries.append(("calib/flat", (prefix, "dome flat", ["ifilter", filter_name])))
+            for filter_name in filters:
+                for proposal in ([None, ] if not proposals else proposals):
+                    addedArgs = [["ifilter", filter_name], ]
+                    if proposal is not None:
+                        addedArgs.append(["proposal", proposal, "contains"])
+                    queries.append(("science", (prefix, "object", addedArgs)))
+        return queries
+
+    @classmethod
+    def fromArchive(cls, start, end, filters, proposals=None, root="rawData", jobs=4):
+        queries = cls.makeQueries(start, end, filters, proposals)
+        results = Downloader.getEach([query for _, query in queries], verbosity=3, jobs=jobs)
+
+        chunks = []
+        for (category, _), result in zip(queries, results):
+            if not len(result):
+                continue
+            chunk = {key: result.get_column(key) for key in cls.columns if key != "subdir"}
+            chunk["subdir"] = np.full(len(result), category)
+            chunks.append(chunk)
+
+        if not chunks:
+            return cls({key: np.array([]) for key in cls.columns}, root, queries)
+
+        files = {key: np.concatenate([chunk[key] for chunk in chunks]) for key in cls.columns}
+        # the first and the last UT date of the range also hold files of
+        # the nights outside of it, keep only the nights of the range
+        nights = {str(night): f"{night:%y%m%d}" for night in cls.nights(start, end)}
+        caldats = np.array([str(caldat)[:10] for caldat in files["caldat"].tolist()])
+        # the same file can be found by more than one query, keep the first
+        # occurrence of each md5sum, in query order
+        _, first = np.unique(files["md5sum"], return_index=True)
+        first = np.sort(first)
+        first = first[np.isin(caldats[first], list(nights))]
+        files = {key: col[first] for key, col in files.items()}
+        files["subdir"] = np.array([
+            f"{nights[caldat]}/{category}" for caldat, category in zip(caldats[first], files["subdir"])
+        ])
+        return cls(files, root, queries)
+
+    @classmethod
+    def fromFile(cls, path):
+        with open(path) as f:
+            plan = json.load(f)
+        files = {key: np.array(plan["files"][key]) for key in cls.columns}
+        return cls(files, plan["root"], plan.get("queries", None))
+
+    def write(self, path):
+        plan = {
+            "root": self.root,
+            "queries": self.queries,
+            "files": {key: col.tolist() for key, col in self.files.items()},
+        }
+        tmppath = f"{path}.tmp"
+        with open(tmppath, "w") as f:
+            json.dump(plan, f, indent=1)
+        os.replace(tmppath, path)
+
+    def __len__(self):
+        return len(self.files["md5sum"])
+
+    @property
+    def sizes(self):
+        # file sizes in bytes, missing sizes are 0
+        sizes = self.files["filesize"]
+        return np.array([0 if size is None else size for size in sizes.tolist()], dtype=np.int64)
+
+    def __str__(self):
+        sizes = self.sizes
+        subdirs, inverse = np.unique(self.files["subdir"], return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(subdirs))
+        nbytes = np.bincount(inverse, weights=sizes, minlength=len(subdirs))
+        dirpaths = [os.path.join(self.root, subdir) for subdir in subdirs]
+        width = max([len(dirpath) for dirpath in dirpaths] + [9])
+        lines = [f"{'directory':{width}}  {'files':>6}  {'size [GB]':>10}"]
+        for dirpath, count, size in zip(dirpaths, counts, nbytes):
+            lines.append(f"{dirpath:{width}}  {count:6}  {size/1e9:10.2f}")
+        lines.append(f"{'total':{width}}  {len(self):6}  {sizes.sum()/1e9:10.2f}")
+        unknown = int((self.files["filesize"] == None).sum())
+        if unknown:
+            lines.append(f"Size of {unknown} files is unknown.")
+        return "\n".join(lines)
+
+    def downloaders(self):
+        # (directory, Downloader) of each target directory
+        for subdir in dict.fromkeys(self.files["subdir"].tolist()):
+            mask = self.files["subdir"] == subdir
+            columns = {key: col[mask] for key, col in self.files.items() if key != "subdir"}
+            yield os.path.join(self.root, subdir), Downloader.fromColumns(columns)
+
+    def run(self, jobs=4, onComplete=None):
+        # Downloads are resumed, and verified files skipped, so an
+        # interrupted plan can simply be run again.
+        failed = []
+        for dirpath, downloader in self.downloaders():
+            os.makedirs(dirpath, exist_ok=True)
+            failed.extend(downloader.downloadTo(dirpath, jobs=jobs, onComplete=onComplete))
+        return failed
 
 
 if __name__=="__main__":
@@ -158,7 +555,7 @@ if __name__=="__main__":
     ##########
     parser.add_argument(
         "--verbosity",
-        help="Verobosity of output, 0-2. Default: 1",
+        help="Verobosity of output, 0-3. Default: 1",
         nargs="?", default="1", dest="verbosity"
     )
     parser.add_argument(
@@ -186,6 +583,84 @@ if __name__=="__main__":
         help="Download selected filters only [gri].",
         nargs="+", default=("g", "r", "i"), dest="filters"
     )
+    parser.add_argument(
+        "--jobs", "-j",
+        help="Number of files downloaded, and archive queries made, concurrently. Default: 4",
+        type=int, nargs="?", default=4, dest="jobs"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help=("Directory where archive query results are cached. "
+              "Default: $XDG_CACHE_HOME/kbmod_imdiff_recipe/queries"),
+        nargs="?", default=None, dest="cacheDir"
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="Hours after which cached archive query results are refreshed, 0 disables the cache. Default: 24",
+        type=float, nargs="?", default=24, dest="cacheTTL"
+    )
+
+    ##########
+    # Planning arguments
+    ##########
+    parser.add_argument(
+        "--nights",
+        help=("Plan the download of the bias, flat and science raws of all nights "
+              "between the two given dates, e.g. 2021-03-18 2021-03-20, inclusive."),
+        nargs=2, default=None, dest="nights"
+    )
+    parser.add_argument(
+        "--proposals",
+        help="Plan the download of the science raws of these proposals only.",
+        nargs="+", default=None, dest="proposals"
+    )
+    parser.add_argument(
+        "--root",
+        help="Directory the planned files are downloaded to. Default: rawData",
+        nargs="?", default="rawData", dest="root"
+    )
+    parser.add_argument(
+        "--write-plan",
+        help="Write the planned downloads to this JSON file.",
+        nargs="?", default=None, dest="writePlan"
+    )
+    parser.add_argument(
+        "--run-plan",
+        help="Download the files listed in a JSON plan file, resuming any previous run.",
+        nargs="?", default=None, dest="runPlan"
+    )
+
+    ##########
+    # Trimming arguments
+    ##########
+    parser.add_argument(
+        "--trim-to",
+        help=(
+            "Trim each file as soon as it is downloaded and write it to this directory, "
+            "under its path relative to --root, see scripts/trim_ccds.py."
+        ),
+        nargs="?", default=None, dest="trimTo"
+    )
+    parser.add_argument(
+        "--trim-hdus",
+        help="Comma separated list of detector IDs (their numerical or string ID) to preserve.",
+        nargs="?", default=None, dest="trimHDUs"
+    )
+    parser.add_argument(
+        "--trim-jobs",
+        help="Number of worker processes used to trim the files. Default: 1",
+        type=int, nargs="?", default=1, dest="trimJobs"
+    )
+    parser.add_argument(
+        "--trim-incremental",
+        help="Skip the trimming of files that are already trimmed and did not change since.",
+        action="store_true", dest="trimIncremental"
+    )
+    parser.add_argument(
+        "--trim-overwrite",
+        help="Overwrite the trimmed files at the destination, if they exist.",
+        action="store_true", dest="trimOverwrite"
+    )
     
 
     ##########
@@ -204,6 +679,52 @@ if __name__=="__main__":
     if not filters:
         raise ValueError("No filters were given, nothing to download.")
 
+    if aargs.cacheTTL > 0:
+        Downloader.cache = QueryCache(aargs.cacheDir, aargs.cacheTTL*3600)
+
+    pipeline, onComplete = None, None
+    if aargs.trimTo is not None:
+        if aargs.trimHDUs is None:
+            raise ValueError("Trimming requires the detectors to preserve, see --trim-hdus.")
+        # trimming requires astropy, import it only when needed
+        from trim_ccds import TrimPipeline
+        pipeline = TrimPipeline(
+            aargs.trimHDUs.split(","),
+            jobs=aargs.trimJobs,
+            verbose=True,
+            overwrite=aargs.trimOverwrite,
+            incremental=aargs.trimIncremental
+        )
+        pipeline.start()
+
+        # trimmed files mirror the layout of the download directories under
+        # --root, which is checked before the downloads start
+        def trimDownloaded(fpath):
+            relpath = os.path.relpath(fpath, aargs.root)
+            pipeline.put(fpath, os.path.join(aargs.trimTo, relpath))
+
+        onComplete = trimDownloaded
+
+    if aargs.runPlan is not None or aargs.nights is not None:
+        if aargs.runPlan is not None:
+            plan = DownloadPlan.fromFile(aargs.runPlan)
+            # trimmed files mirror the layout of the plan
+            aargs.root = plan.root
+        else:
+            plan = DownloadPlan.fromArchive(*aargs.nights, filters, aargs.proposals,
+                                            root=aargs.root, jobs=aargs.jobs)
+        print(plan)
+
+        if aargs.writePlan is not None:
+            plan.write(aargs.writePlan)
+
+        failed = []
+        if aargs.runPlan is not None or aargs.downloadAll or aargs.downloadAll is None:
+            failed = plan.run(jobs=aargs.jobs, onComplete=onComplete)
+        if pipeline is not None:
+            failed.extend(pipeline.close()["failed"])
+        raise SystemExit(1 if failed else 0)
+
     print(" "*26+"BIAS RAW")
     print("#"*60)
     bias = Downloader.get("c4d_210318", "zero", verbosity=aargs.verbosity)
@@ -212,23 +733,21 @@ if __name__=="__main__":
     print()
     print(" "*26+"FLAT RAW")
     print("#"*60)
-    flat = Downloader.get("c4d_210318", "dome flat", ["ifilter", filters[0]], verbosity=aargs.verbosity)
-    for filter_name in filters[1:]:
-        flat.extend(Downloader.get("c4d_210318", "dome flat", ["ifilter", filter_name], verbosity=aargs.verbosity))
+    flatQueries = [("c4d_210318", "dome flat", ["ifilter", filter_name]) for filter_name in filters]
+    flat = Downloader.getMany(flatQueries, verbosity=aargs.verbosity, jobs=aargs.jobs)
     print(flat)
 
     print()
     print(" "*25+"SCIENCE RAW")
     print("#"*60)
-    addedArgs = [
-        ["ifilter", filters[0]],
-        ["proposal", "2021A-0113", "contains"],
-    ]
-    science = Downloader.get("c4d_210319", "object", addedArgs, verbosity=aargs.verbosity)
-
-    for filter_name in filters[1:]:
-        addedArgs[0][1] = filter_name
-        science.extend(Downloader.get("c4d_210319", "object", addedArgs, verbosity=aargs.verbosity))
+    scienceQueries = []
+    for filter_name in filters:
+        addedArgs = [
+            ["ifilter", filter_name],
+            ["proposal", "2021A-0113", "contains"],
+        ]
+        scienceQueries.append(("c4d_210319", "object", addedArgs))
+    science = Downloader.getMany(scienceQueries, verbosity=aargs.verbosity, jobs=aargs.jobs)
     print(science)
 
     if aargs.downloadAll:
@@ -244,14 +763,36 @@ if __name__=="__main__":
         os.makedirs(pth, exist_ok=True)
         return pth
 
+    downloads = []
     if aargs.downloadBias or aargs.downloadBias is None:
         biasDir = create_save_dirs(aargs.downloadBias, "../rawData/210318/calib/bias")
-        bias.downloadTo(biasDir)
+        downloads.append((bias, biasDir))
         
     if aargs.downloadFlats or aargs.downloadFlats is None:
         flatDir = create_save_dirs(aargs.downloadFlats, "../rawData/210318/calib/flat")
-        flat.downloadTo(flatDir)
+        downloads.append((flat, flatDir))
 
     if aargs.downloadScience or aargs.downloadScience is None:
         sciDir = create_save_dirs(aargs.downloadScience, "../rawData/210318/science")
-        science.downloadTo(sciDir)
+        downloads.append((science, sciDir))
+
+    if pipeline is not None:
+        outside = [dirpath for _, dirpath in downloads
+                   if os.path.relpath(dirpath, aargs.root).startswith(os.pardir)]
+        if outside:
+            pipeline.close()
+            raise ValueError(f"Can not trim the files downloaded to {', '.join(outside)}, "
+                             f"they are not in the --root {aargs.root} directory.")
+
+    failed = []
+    for downloader, dirpath in downloads:
+        failed.extend(downloader.downloadTo(dirpath, jobs=aargs.jobs, onComplete=onComplete))
+
+    # failed trims are reported by the pipeline itself
+    trimFailed = [] if pipeline is None else pipeline.close()["failed"]
+
+    if failed:
+        print(f"{len(failed)} downloads FAILED:")
+        for label in failed:
+            print(f"    {label}")
+    raise SystemExit(1 if failed or trimFailed else 0)
@@ -0,0 +1,151 @@
+"""Helpers shared by the scripts of the recipe."""
+import os
+
+import numpy as np
+
+
+############################################################
+#                         FITS headers
+############################################################
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+
+def _card_value(card):
+    """Value of a fixed-format header card: a string, a boolean, an integer
+    or a float. Undefined values are `None`, and the values of any other
+    type, i.e. complex numbers, are returned as the raw string."""
+    value = card[10:].strip()
+    if value.startswith(b"'"):
+        # quotes are escaped by doubling them
+        end = 1
+        while True:
+            end = value.find(b"'", end)
+            if end < 0 or value[end+1:end+2] != b"'":
+                break
+            end += 2
+        return value[1:end].replace(b"''", b"'").rstrip().decode("ascii")
+    value = value.split(b"/")[0].strip()
+    if not value:
+        return None
+    if value in (b"T", b"F"):
+        return value == b"T"
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace(b"D", b"E"))
+    except ValueError:
+        return value.decode("ascii", errors="replace")
+
+
+def fits_data_size(header):
+    """Size, in bytes, of the data unit described by the header as it is
+    on disk, padded to a whole number of FITS blocks.
+
+    Parameters
+    ----------
+    header : `dict` or `astropy.io.fits.Header`
+        Header of the HDU. For tile-compressed images, the header of the
+        binary table, not the one of the compressed image.
+
+    Returns
+    -------
+    size : `int`
+        Number of bytes to seek over to reach the next HDU.
+    """
+    naxis = header.get("NAXIS", 0)
+    if naxis == 0:
+        return 0
+    nbytes = int(np.prod([header[f"NAXIS{n}"] for n in range(1, naxis+1)]))
+    nbytes = abs(header["BITPIX"])//8 * header.get("GCOUNT", 1) * (header.get("PCOUNT", 0) + nbytes)
+    return -(-nbytes // FITS_BLOCK) * FITS_BLOCK
+
+
+def read_fits_headers(fitsPath, hdus=None):
+    """Read the headers of the HDUs of a FITS file without reading, or
+    decompressing, any of the data units, which are seeked over.
+
+    Only keyword-value cards are kept, commentary, ``HIERARCH`` and
+    ``CONTINUE`` cards are skipped. Headers of tile-compressed images
+    describe the compressed image, i.e. their ``XTENSION``, ``BITPIX``,
+    ``NAXIS``, ``PCOUNT`` and ``GCOUNT`` keywords are replaced by the
+    ``Z`` prefixed ones.
+
+    Parameters
+    ----------
+    fitsPath : `str`
+        Path to the FITS file.
+    hdus : `list` or `None`
+        Indices of the HDUs to read. Only the sizes of the data units of the
+        other HDUs are read. When `None` reads all of them.
+
+    Returns
+    -------
+    headers : `dict`
+        HDU index and header pairs, headers are keyword-value dictionaries.
+
+    Raises
+    ------
+    IndexError
+        When any of the given HDUs is not in the file.
+    """
+    sizeKeys = (b"BITPIX", b"NAXIS", b"PCOUNT", b"GCOUNT")
+    wanted = None if hdus is None else set(hdus)
+    last = None if hdus is None else max(wanted, default=-1)
+    headers = {}
+    with open(fitsPath, "rb") as f:
+        i = 0
+        while last is None or i <= last:
+            keep = wanted is None or i in wanted
+            hdr, end = {}, False
+            while not end:
+                block = f.read(FITS_BLOCK)
+                if len(block) < FITS_BLOCK:
+                    break
+                for k in range(0, FITS_BLOCK, FITS_CARD):
+                    card = block[k:k+FITS_CARD]
+                    key = card[:8].rstrip()
+                    if key == b"END":
+                        end = True
+                        break
+                    if card[8:10] != b"= " or not (keep or key.startswith(sizeKeys)):
+                        continue
+                    hdr[key.decode("ascii")] = _card_value(card)
+            if not end:
+                break
+
+            if hdr.get("ZIMAGE", False):
+                sizes = {k: hdr[k] for k in hdr if k.startswith(("NAXIS", "BITPIX", "PCOUNT", "GCOUNT"))}
+                hdr.update(XTENSION="IMAGE", BITPIX=hdr["ZBITPIX"], NAXIS=hdr["ZNAXIS"],
+                           PCOUNT=hdr.get("ZPCOUNT", 0), GCOUNT=hdr.get("ZGCOUNT", 1))
+                for n in range(1, hdr["ZNAXIS"]+1):
+                    hdr[f"NAXIS{n}"] = hdr[f"ZNAXIS{n}"]
+            else:
+                sizes = hdr
+            if keep:
+                headers[i] = hdr
+
+            f.seek(fits_data_size(sizes), os.SEEK_CUR)
+            i += 1
+
+    if wanted is not None and not wanted.issubset(headers):
+        raise IndexError(f"HDUs {sorted(wanted - set(headers))} not found in {fitsPath}.")
+    return headers
+
+
+############################################################
+#                         Sky coordinates
+############################################################
+def radec2vec(ra, dec):
+    """Convert ICRS coordinates, in degrees, to unit vectors."""
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
+
+
+def vec2radec(vec):
+    """Convert unit vectors to ICRS coordinates, in degrees."""
+    ra = np.degrees(np.arctan2(vec[..., 1], vec[..., 0])) % 360
+    dec = np.degrees(np.arcsin(np.clip(vec[..., 2], -1, 1)))
+    return ra, dec
@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 
 import os
+import re
 import glob
 import shutil
+import sqlite3
+import filecmp
+import hashlib
 import argparse
 import itertools
 import importlib
-import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from recipe_utils import read_fits_headers, radec2vec
 
 
 ############################################################
@@ -117,6 +125,365 @@ def build_table(ids, names, paths, padding=1):
     return prtstr
 
 
+############################################################
+#                         HTM
+############################################################
+# Vertices of the 8 root trixels, S0-S3 and N0-N3, of the Hierarchical
+# Triangular Mesh, in the order used by `lsst.sphgeom.HtmPixelization`, so
+# that the trixel IDs computed here match the reference catalog shard IDs.
+HTM_ROOT_VERTICES = np.array([
+    [[1, 0, 0], [0, 0, -1], [0, 1, 0]],    # S0
+    [[0, 1, 0], [0, 0, -1], [-1, 0, 0]],   # S1
+    [[-1, 0, 0], [0, 0, -1], [0, -1, 0]],  # S2
+    [[0, -1, 0], [0, 0, -1], [1, 0, 0]],   # S3
+    [[1, 0, 0], [0, 0, 1], [0, -1, 0]],    # N0
+    [[0, -1, 0], [0, 0, 1], [-1, 0, 0]],   # N1
+    [[-1, 0, 0], [0, 0, 1], [0, 1, 0]],    # N2
+    [[0, 1, 0], [0, 0, 1], [1, 0, 0]],     # N3
+], dtype=float)
+HTM_ROOT_IDS = np.arange(8, 16)
+
+# slack, in units of the unit vector dot products, making the
+# intersection tests conservative w.r.t. the floating point errors
+HTM_EPS = 1e-12
+
+
+def _normalize(v):
+    """Normalize the vectors along the last axis."""
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+def htm_children(vertices):
+    """Split trixels into their 4 children.
+
+    Parameters
+    ----------
+    vertices : `np.array`
+        Array of shape ``(N, 3, 3)``, the vertices of the trixels.
+
+    Returns
+    -------
+    children : `np.array`
+        Array of shape ``(N, 4, 3, 3)``, the vertices of the children in the
+        order of their IDs, ``4*parentId + i``.
+    """
+    v0, v1, v2 = vertices[:, 0], vertices[:, 1], vertices[:, 2]
+    w0 = _normalize(v1 + v2)
+    w1 = _normalize(v0 + v2)
+    w2 = _normalize(v0 + v1)
+    return np.stack([
+        np.stack([v0, w2, w1], axis=1),
+        np.stack([v1, w0, w2], axis=1),
+        np.stack([v2, w1, w0], axis=1),
+        np.stack([w0, w1, w2], axis=1),
+    ], axis=1)
+
+
+def htm_contains(vertices, points):
+    """Test if the trixels contain the points, edges included.
+
+    Parameters
+    ----------
+    vertices : `np.array`
+        Array of shape ``(..., 3, 3)``, vertices of the trixels.
+    points : `np.array`
+        Array of shape ``(..., 3)``, unit vectors.
+
+    Returns
+    -------
+    contained : `np.array`
+        Boolean array of shape ``(..., )``.
+    """
+    v0, v1, v2 = vertices[..., 0, :], vertices[..., 1, :], vertices[..., 2, :]
+    return (
+        (np.einsum("...i,...i", np.cross(v0, v1), points) >= -HTM_EPS)
+        & (np.einsum("...i,...i", np.cross(v1, v2), points) >= -HTM_EPS)
+        & (np.einsum("...i,...i", np.cross(v2, v0), points) >= -HTM_EPS)
+    )
+
+
+def htm_intersects_circle(vertices, centers, radii):
+    """Test if the trixels intersect the circles.
+
+    A trixel intersects a circle if the circle's center is in the trixel,
+    one of the trixel's vertices is in the circle, or one of the trixel's
+    edges passes closer to the center than the radius.
+
+    Parameters
+    ----------
+    vertices : `np.array`
+        Array of shape ``(N, 3, 3)``, vertices of the trixels.
+    centers : `np.array`
+        Array of shape ``(N, 3)``, unit vectors of the circle centers.
+    radii : `np.array`
+        Array of shape ``(N, )``, radii of the circles in radians, smaller
+        than 90 degrees.
+
+    Returns
+    -------
+    intersects : `np.array`
+        Boolean array of shape ``(N, )``.
+    """
+    cosr, sinr = np.cos(radii), np.sin(radii)
+    intersects = htm_contains(vertices, centers)
+    for i in range(3):
+        a, b = vertices[:, i], vertices[:, (i+1) % 3]
+        intersects |= np.einsum("ij,ij->i", a, centers) >= cosr - HTM_EPS
+
+        # distance to the great circle of the edge, valid only when the
+        # closest point of the great circle lies on the edge itself
+        n = _normalize(np.cross(a, b))
+        cn = np.einsum("ij,ij->i", centers, n)
+        q = centers - cn[:, None]*n
+        onEdge = (
+            (np.einsum("ij,ij->i", np.cross(a, q), n) >= -HTM_EPS)
+            & (np.einsum("ij,ij->i", np.cross(q, b), n) >= -HTM_EPS)
+        )
+        intersects |= onEdge & (np.abs(cn) <= sinr + HTM_EPS)
+    return intersects
+
+
+def htm_index(points, depth=7):
+    """Return the IDs of the trixels, at the given depth, containing the
+    points.
+
+    Parameters
+    ----------
+    points : `np.array`
+        Array of shape ``(N, 3)``, unit vectors.
+    depth : `int`
+        Subdivision level of the mesh. Default: 7.
+
+    Returns
+    -------
+    ids : `np.array`
+        Integer trixel IDs.
+    """
+    points = np.atleast_2d(points)
+    inRoot = htm_contains(HTM_ROOT_VERTICES[None, :], points[:, None])
+    root = np.argmax(inRoot, axis=1)
+    ids, vertices = HTM_ROOT_IDS[root], HTM_ROOT_VERTICES[root]
+    for _ in range(depth):
+        children = htm_children(vertices)
+        # the central child 3 is the fallback, points on shared edges go
+        # to the first child containing them
+        inChild = htm_contains(children[:, :3], points[:, None])
+        child = np.where(inChild.any(axis=1), np.argmax(inChild, axis=1), 3)
+        ids = 4*ids + child
+        vertices = children[np.arange(len(points)), child]
+    return ids
+
+
+def htm_intersects_polygon(vertices, polygons):
+    """Test if the trixels intersect the convex polygons.
+
+    A trixel intersects a polygon if one of the polygon's vertices is in
+    the trixel, one of the trixel's vertices is in the polygon, or one of
+    their edges cross.
+
+    Parameters
+    ----------
+    vertices : `np.array`
+        Array of shape ``(N, 3, 3)``, vertices of the trixels.
+    polygons : `np.array`
+        Array of shape ``(N, K, 3)``, vertices of the convex polygons, in
+        counter-clockwise order, with edges shorter than 180 degrees.
+
+    Returns
+    -------
+    intersects : `np.array`
+        Boolean array of shape ``(N, )``.
+    """
+    intersects = htm_contains(vertices[:, None], polygons).any(axis=1)
+
+    edgeNormals = np.cross(polygons, np.roll(polygons, -1, axis=1))
+    inPolygon = np.einsum("nkj,nij->nik", edgeNormals, vertices) >= -HTM_EPS
+    intersects |= inPolygon.all(axis=2).any(axis=1)
+
+    def onArc(a, b, n, x):
+        return (
+            (np.einsum("...j,...j", np.cross(a, x), n) >= -HTM_EPS)
+            & (np.einsum("...j,...j", np.cross(x, b), n) >= -HTM_EPS)
+        )
+
+    for i in range(3):
+        a, b = vertices[:, None, i], vertices[:, None, (i+1) % 3]
+        c, d = polygons, np.roll(polygons, -1, axis=1)
+        nab = np.broadcast_to(np.cross(a, b), c.shape)
+        ncd = np.cross(c, d)
+        # the great circles of the edges cross at +/- x, the edges cross
+        # if either of the two points is on both of them
+        x = np.cross(nab, ncd)
+        norm = np.linalg.norm(x, axis=-1, keepdims=True)
+        valid = norm[..., 0] > HTM_EPS
+        x = np.divide(x, norm, out=np.zeros_like(x), where=norm > HTM_EPS)
+        for sx in (x, -x):
+            intersects |= (valid & onArc(a, b, nab, sx) & onArc(c, d, ncd, sx)).any(axis=1)
+    return intersects
+
+
+def _htm_descend(intersects, nregions, depth):
+    """Return all region-trixel pairs, at the given depth, that intersect.
+
+    All regions are resolved together, descending the mesh one level at a
+    time and keeping only the intersecting trixel-region pairs.
+
+    Parameters
+    ----------
+    intersects : `callable`
+        Called with the vertices of the trixels and the indices of the
+        regions they are paired with, returns a boolean array.
+    nregions : `int`
+        Number of regions.
+    depth : `int`
+        Subdivision level of the mesh.
+
+    Returns
+    -------
+    regions : `np.array`
+        Indices of the regions.
+    ids : `np.array`
+        Integer IDs of the trixels intersecting the paired regions.
+    """
+    if nregions == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    # every root trixel-region pair
+    region = np.repeat(np.arange(nregions), len(HTM_ROOT_IDS))
+    ids = np.tile(HTM_ROOT_IDS, nregions)
+    vertices = np.tile(HTM_ROOT_VERTICES, (nregions, 1, 1))
+    for level in range(depth+1):
+        keep = intersects(vertices, region)
+        region, ids, vertices = region[keep], ids[keep], vertices[keep]
+        if level == depth:
+            break
+        vertices = htm_children(vertices).reshape(-1, 3, 3)
+        ids = (4*ids[:, None] + np.arange(4)).ravel()
+        region = np.repeat(region, 4)
+    return region, ids
+
+
+def htm_envelope(centers, radii, depth=7, perRegion=False):
+    """Return the IDs of all trixels, at the given depth, intersecting any
+    of the given circles.
+
+    Parameters
+    ----------
+    centers : `np.array`
+        Array of shape ``(N, 3)``, unit vectors of the circle centers.
+    radii : `np.array`
+        Array of shape ``(N, )``, radii of the circles in radians.
+    depth : `int`
+        Subdivision level of the mesh. Default: 7.
+    perRegion : `bool`
+        Return the intersecting circle-trixel pairs instead.
+
+    Returns
+    -------
+    ids : `np.array`
+        Sorted unique integer trixel IDs or, when ``perRegion``, a tuple
+        of the circle indices and the trixel IDs intersecting them.
+    """
+    centers = np.atleast_2d(centers)
+    radii = np.atleast_1d(radii)
+    regions, ids = _htm_descend(
+        lambda vertices, i: htm_intersects_circle(vertices, centers[i], radii[i]),
+        len(centers) if centers.size else 0,
+        depth
+    )
+    return (regions, ids) if perRegion else np.unique(ids)
+
+
+def htm_polygon_envelope(polygons, depth=7, perRegion=False):
+    """Return the IDs of all trixels, at the given depth, intersecting any
+    of the given convex polygons.
+
+    Parameters
+    ----------
+    polygons : `np.array`
+        Array of shape ``(N, K, 3)``, vertices of the convex polygons, in
+        counter-clockwise order.
+    depth : `int`
+        Subdivision level of the mesh. Default: 7.
+    perRegion : `bool`
+        Return the intersecting polygon-trixel pairs instead.
+
+    Returns
+    -------
+    ids : `np.array`
+        Sorted unique integer trixel IDs or, when ``perRegion``, a tuple
+        of the polygon indices and the trixel IDs intersecting them.
+    """
+    polygons = np.asarray(polygons, dtype=float)
+    regions, ids = _htm_descend(
+        lambda vertices, i: htm_intersects_polygon(vertices, polygons[i]),
+        len(polygons),
+        depth
+    )
+    return (regions, ids) if perRegion else np.unique(ids)
+
+
+def convex_hull(points):
+    """Return the convex hull of the points, which must all lie within a
+    hemisphere, as a counter-clockwise polygon.
+
+    The points are projected on the plane tangent to their mean, where the
+    hull is computed, since the gnomonic projection maps great circles to
+    lines.
+
+    Parameters
+    ----------
+    points : `np.array`
+        Array of shape ``(N, 3)``, unit vectors.
+
+    Returns
+    -------
+    hull : `np.array`
+        Array of shape ``(K, 3)``, vertices of the hull.
+    """
+    center = _normalize(points.mean(axis=0))
+    east = _normalize(np.cross([0, 0, 1], center) if abs(center[2]) < 0.9
+                      else np.cross([1, 0, 0], center))
+    north = np.cross(center, east)
+    proj = points / (points @ center)[:, None]
+    xy = np.stack([proj @ east, proj @ north], axis=-1)
+
+    # Andrew's monotone chain
+    order = np.lexsort((xy[:, 1], xy[:, 0]))
+    def half(idxs):
+        chain = []
+        for i in idxs:
+            while len(chain) > 1:
+                o, a = xy[chain[-2]], xy[chain[-1]]
+                if (a[0]-o[0])*(xy[i][1]-o[1]) - (a[1]-o[1])*(xy[i][0]-o[0]) > 0:
+                    break
+                chain.pop()
+            chain.append(i)
+        return chain[:-1]
+    hull = half(order) + half(order[::-1])
+    return orient_polygons(points[hull][None])[0]
+
+
+def orient_polygons(polygons):
+    """Reverse the order of the vertices of the convex polygons that are
+    not counter-clockwise.
+
+    Parameters
+    ----------
+    polygons : `np.array`
+        Array of shape ``(N, K, 3)``, vertices of the convex polygons.
+
+    Returns
+    -------
+    polygons : `np.array`
+        Counter-clockwise polygons.
+    """
+    orientation = np.einsum(
+        "nj,nj->n", np.cross(polygons[:, 0], polygons[:, 1]), polygons[:, 2]
+    )
+    return np.where((orientation < 0)[:, None, None], polygons[:, ::-1], polygons)
+
+
 ############################################################
 #                         Resolvers
 ############################################################
@@ -251,18 +618,17 @@ def resolve_decamraw_shard_ids(refCatConf, fitsPath, detectors=None, pixelMargin
     shard_ids : `list`
         IDs of reference catalog shards overlapping the region.
     """
-    hdul = fitsio.open(fitsPath)
+    headers = read_fits_headers(fitsPath, detectors)
 
     shardIds = []
-    bbox = geom.Box2D(geom.Point2D(0, 0), geom.Extent2D(hdul[1].header["NAXIS1"], hdul[1].header["NAXIS2"]))
-
     if isinstance(detectors, list) or isinstance(detectors, tuple):
-        usehdus = [hdul[i] for i in detectors]
+        useheaders = [headers[i] for i in detectors]
     else:
-        usehdus = hdul[1:]
+        useheaders = [hdr for i, hdr in headers.items() if i > 0]
 
-    for hdu in usehdus:
-        wcs = awcs.WCS(hdu.header)
+    for hdr in useheaders:
+        bbox = geom.Box2D(geom.Point2D(0, 0), geom.Extent2D(hdr["NAXIS1"], hdr["NAXIS2"]))
+        wcs = awcs.WCS(fitsio.Header(hdr))
         crpix = geom.Point2D(wcs.wcs.crpix)
         crval = geom.SpherePoint(longitude=wcs.wcs.crval[0], latitude=wcs.wcs.crval[1], units=geom.degrees)
         skyWcs = afwGeom.makeSkyWcs(crpix=crpix, crval=crval, cdMatrix=wcs.wcs.cd, projection="TAN")
@@ -272,13 +638,832 @@ def resolve_decamraw_shard_ids(refCatConf, fitsPath, detectors=None, pixelMargin
     return list(set(shardIds))
 
 
+def _read_detector_wcs(fitsPaths, detectors=None):
+    """Read the detector WCS of the files, see `read_detector_wcs`."""
+    shapes, crpix, crval, cd, exposures, hdus = [], [], [], [], [], []
+    for i, fitsPath in enumerate(fitsPaths):
+        headers = read_fits_headers(fitsPath, detectors)
+        if isinstance(detectors, list) or isinstance(detectors, tuple):
+            headers = [(j, headers[j]) for j in detectors]
+        else:
+            headers = [(j, hdr) for j, hdr in headers.items() if j > 0]
+
+        for j, hdr in headers:
+            if "CRVAL1" not in hdr or hdr.get("NAXIS", 0) != 2:
+                continue
+            exposures.append(i)
+            hdus.append(j)
+            shapes.append([hdr["NAXIS1"], hdr["NAXIS2"]])
+            crpix.append([hdr["CRPIX1"], hdr["CRPIX2"]])
+            crval.append([hdr["CRVAL1"], hdr["CRVAL2"]])
+            if "CD1_1" in hdr:
+                cd.append([[hdr.get("CD1_1", 0), hdr.get("CD1_2", 0)],
+                           [hdr.get("CD2_1", 0), hdr.get("CD2_2", 0)]])
+            else:
+                pc = np.array([[hdr.get("PC1_1", 1), hdr.get("PC1_2", 0)],
+                               [hdr.get("PC2_1", 0), hdr.get("PC2_2", 1)]])
+                cd.append(pc * np.array([hdr["CDELT1"], hdr["CDELT2"]])[:, None])
+
+    return (np.array(shapes, dtype=float).reshape(-1, 2), np.array(crpix, dtype=float).reshape(-1, 2),
+            np.array(crval, dtype=float).reshape(-1, 2), np.array(cd, dtype=float).reshape(-1, 2, 2),
+            np.array(exposures, dtype=int), np.array(hdus, dtype=int))
+
+
+def read_detector_wcs(fitsPaths, detectors=None, jobs=1):
+    """Read the sizes and the TAN WCS parameters of the detectors from the
+    headers of the FITS files, without reading any data.
+
+    Parameters
+    ----------
+    fitsPaths : `list`
+        Paths to the FITS files.
+    detectors : `list` or `None`
+        HDU indices of the detectors to read. When `None` reads all of the
+        image-like HDUs with a celestial WCS.
+    jobs : `int`
+        Number of worker processes the files are split between. Default: 1.
+
+    Returns
+    -------
+    shapes : `np.array`
+        Array of shape ``(N, 2)``, the ``NAXIS1`` and ``NAXIS2`` of the
+        detectors.
+    crpix : `np.array`
+        Array of shape ``(N, 2)``, the FITS, 1-based, reference pixels.
+    crval : `np.array`
+        Array of shape ``(N, 2)``, ICRS coordinates of the reference pixels
+        in degrees.
+    cd : `np.array`
+        Array of shape ``(N, 2, 2)``, the CD matrices in degrees per pixel.
+    exposures : `np.array`
+        Array of shape ``(N, )``, index of the file of each detector.
+    hdus : `np.array`
+        Array of shape ``(N, )``, HDU index of each detector.
+    """
+    fitsPaths = list(fitsPaths)
+    jobs = min(jobs, len(fitsPaths))
+    if jobs <= 1:
+        return _read_detector_wcs(fitsPaths, detectors)
+
+    # few, contiguous, chunks per worker keep the exposure indices simple
+    # to offset and the pickling overhead low
+    bounds = np.linspace(0, len(fitsPaths), 4*jobs+1).astype(int)
+    chunks = [fitsPaths[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+    offsets = np.cumsum([0] + [len(c) for c in chunks[:-1]])
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(_read_detector_wcs, chunks, itertools.repeat(detectors)))
+
+    columns = [np.concatenate(c) for c in zip(*results)]
+    columns[4] = np.concatenate([r[4] + o for r, o in zip(results, offsets)])
+    return tuple(columns)
+
+
+def tan_pixel_to_sky(pixels, crpix, crval, cd):
+    """Convert pixel coordinates to unit vectors using the gnomonic (TAN)
+    projection, ignoring any distortion terms.
+
+    Parameters
+    ----------
+    pixels : `np.array`
+        Array of shape ``(N, K, 2)``, zero-based pixel coordinates of ``K``
+        points on each of the ``N`` detectors.
+    crpix : `np.array`
+        Array of shape ``(N, 2)``, the FITS, 1-based, reference pixels.
+    crval : `np.array`
+        Array of shape ``(N, 2)``, coordinates of the reference pixels in
+        degrees.
+    cd : `np.array`
+        Array of shape ``(N, 2, 2)``, the CD matrices.
+
+    Returns
+    -------
+    vectors : `np.array`
+        Array of shape ``(N, K, 3)``, unit vectors.
+    """
+    # standard (tangent plane) coordinates, in radians
+    offsets = pixels + 1 - crpix[:, None, :]
+    xi, eta = np.radians(np.einsum("nij,nkj->nki", cd, offsets)).transpose(2, 0, 1)
+
+    ra, dec = np.radians(crval[:, 0]), np.radians(crval[:, 1])
+    center = radec2vec(crval[:, 0], crval[:, 1])
+    east = np.stack([-np.sin(ra), np.cos(ra), np.zeros_like(ra)], axis=-1)
+    north = np.stack([-np.sin(dec)*np.cos(ra), -np.sin(dec)*np.sin(ra), np.cos(dec)], axis=-1)
+    return _normalize(
+        center[:, None] + xi[..., None]*east[:, None] + eta[..., None]*north[:, None]
+    )
+
+
+def calculate_circles(shapes, crpix, crval, cd, pixelMargin=300):
+    """Computes on-sky centers and radii of the circles circumscribing the
+    detectors' bounding boxes, expanded by the margin, in one pass.
+
+    This is the vectorized equivalent of `calculate_circle`.
+
+    Parameters
+    ----------
+    shapes : `np.array`
+        Array of shape ``(N, 2)``, the sizes of the detectors.
+    crpix, crval, cd : `np.array`
+        TAN WCS parameters of the detectors, see `read_detector_wcs`.
+    pixelMargin : `int` or `float`
+        Padding in pixels by which the bounding boxes are expanded.
+
+    Returns
+    -------
+    centers : `np.array`
+        Array of shape ``(N, 3)``, unit vectors of the circle centers.
+    radii : `np.array`
+        Array of shape ``(N, )``, radii of the circles in radians.
+    """
+    pixels = _bbox_pixels(shapes, pixelMargin, center=True)
+    vectors = tan_pixel_to_sky(pixels, crpix, crval, cd)
+    centers = vectors[:, 0]
+    cosd = np.einsum("nj,nkj->nk", centers, vectors[:, 1:])
+    radii = np.arccos(np.clip(cosd, -1, 1)).max(axis=1)
+    return centers, radii
+
+
+def _bbox_pixels(shapes, pixelMargin, center=False):
+    """Corners, in counter-clockwise pixel order, and optionally the
+    center, preceding them, of the bounding boxes grown by the margin."""
+    lo = np.full_like(shapes, -pixelMargin)
+    hi = shapes + pixelMargin
+    pixels = [
+        lo,
+        np.stack([hi[:, 0], lo[:, 1]], axis=-1),
+        hi,
+        np.stack([lo[:, 0], hi[:, 1]], axis=-1),
+    ]
+    if center:
+        pixels.insert(0, (lo + hi) / 2)
+    return np.stack(pixels, axis=1)
+
+
+def calculate_polygons(shapes, crpix, crval, cd, pixelMargin=300):
+    """Computes on-sky polygons of the detectors' bounding boxes, expanded
+    by the margin, in one pass.
+
+    The edges of the bounding boxes are straight lines in the tangent plane
+    and so great circles on the sky, the polygons are exact.
+
+    Parameters
+    ----------
+    shapes : `np.array`
+        Array of shape ``(N, 2)``, the sizes of the detectors.
+    crpix, crval, cd : `np.array`
+        TAN WCS parameters of the detectors, see `read_detector_wcs`.
+    pixelMargin : `int` or `float`
+        Padding in pixels by which the bounding boxes are expanded.
+
+    Returns
+    -------
+    polygons : `np.array`
+        Array of shape ``(N, 4, 3)``, counter-clockwise polygons.
+    """
+    pixels = _bbox_pixels(shapes, pixelMargin)
+    return orient_polygons(tan_pixel_to_sky(pixels, crpix, crval, cd))
+
+
+def merge_polygons(polygons, groups):
+    """Merge the polygons of each group into the polygon of their convex
+    hull, f.e. the detectors of an exposure into a focal-plane footprint.
+
+    Parameters
+    ----------
+    polygons : `np.array`
+        Array of shape ``(N, K, 3)``, polygons.
+    groups : `np.array`
+        Array of shape ``(N, )``, group of each polygon.
+
+    Returns
+    -------
+    merged : `list`
+        Polygons, one per group.
+    """
+    return [convex_hull(polygons[groups == g].reshape(-1, 3)) for g in np.unique(groups)]
+
+
+def resolve_htm_shard_pairs(fitsPaths, detectors=None, pixelMargin=300, depth=7,
+                            region="detector", jobs=1):
+    """Resolves the HTM shards overlapping each detector, or exposure, of
+    the given FITS files, see `resolve_decamraw_htm_shard_ids`.
+
+    Returns
+    -------
+    exposures : `np.array`
+        Index of the file of each exposure, detector and shard triplet.
+    detectors : `np.array`
+        HDU index of the detector of each triplet, -1 when the region is
+        the whole exposure.
+    shard_ids : `np.array`
+        IDs of the shards overlapping the region of each triplet.
+    """
+    shapes, crpix, crval, cd, exposures, hdus = read_detector_wcs(fitsPaths, detectors, jobs)
+
+    if region == "circle":
+        centers, radii = calculate_circles(shapes, crpix, crval, cd, pixelMargin)
+        regions, ids = htm_envelope(centers, radii, depth, perRegion=True)
+        return exposures[regions], hdus[regions], ids
+
+    polygons = calculate_polygons(shapes, crpix, crval, cd, pixelMargin)
+    if region == "detector":
+        regions, ids = htm_polygon_envelope(polygons, depth, perRegion=True)
+        return exposures[regions], hdus[regions], ids
+    elif region == "exposure":
+        groups = np.unique(exposures)
+        ids = [htm_polygon_envelope(hull[None], depth) for hull in merge_polygons(polygons, exposures)]
+        counts = [len(i) for i in ids]
+        return (np.repeat(groups, counts), np.full(sum(counts), -1, dtype=int),
+                np.concatenate(ids) if ids else np.array([], dtype=int))
+
+    raise ValueError(f"Unknown region {region}, expected detector, exposure or circle.")
+
+
+def resolve_decamraw_htm_shard_ids(fitsPaths, detectors=None, pixelMargin=300, depth=7,
+                                   region="detector", index=None, jobs=1):
+    """Resolves IDs of HTM shards overlapping the detectors of all the given
+    FITS files, without the Rubin stack.
+
+    Only the headers of the files are read, split between ``jobs`` worker
+    processes. The detector corners of all of the files are then computed
+    in a single vectorized pass and the shards overlapping any of
+    the detector regions are resolved together, see `htm_polygon_envelope`.
+    Like `resolve_decamraw_shard_ids` the WCS is approximated by its TAN
+    projection.
+
+    Parameters
+    ----------
+    fitsPaths : `list`
+        Paths to the FITS files.
+    detectors : `list` or `None`
+        List of integer IDs of the detectors for which
+        overlapping shards will be found. When `None`
+        uses all of the image-like detectors.
+    pixelMargin: `int`
+        Bounding box padding, in pixels. Default: 300.
+    depth : `int`
+        Depth of the HTM indexer. Default: 7.
+    region : `str`
+        Region of the sky the shards are resolved for. One of:
+        ``detector`` - the polygon of each detector (default),
+        ``exposure`` - the convex hull of the detector polygons of each
+        file, which includes the chip gaps but has fewer, longer, edges,
+        ``circle`` - the circle circumscribing each detector, selecting
+        the same shards as the stack resolver.
+    index : `ShardIndex` or `None`
+        Index of previously resolved exposures. Only the exposures missing
+        from it are resolved, and then added to it. Not used for exposure
+        regions of a subset of the detectors.
+    jobs : `int`
+        Number of worker processes reading the headers. Default: 1.
+
+    Returns
+    ----------
+    shard_ids : `list`
+        IDs of reference catalog shards overlapping the region.
+    """
+    if index is not None and not (region == "exposure" and detectors is not None):
+        return index.resolve(fitsPaths, detectors, pixelMargin, depth, region, jobs)
+
+    _, _, ids = resolve_htm_shard_pairs(fitsPaths, detectors, pixelMargin, depth, region, jobs)
+    return np.unique(ids).tolist()
+
+
 ############################################################
-#                         Main
+#                         Shard index
+############################################################
+class ShardIndex:
+    """Persistent, on-disk, index of the HTM shards overlapping each
+    detector of the resolved exposures.
+
+    Exposures are identified by the MD5 checksum of their file, so the index
+    remains valid when files are moved or copied, and can be shared between
+    reference catalogs using the same indexer and between runs. Checksums
+    are only computed for the files whose path, size or modification time
+    changed since they were last seen.
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the SQLite database file, created when it does not exist.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS exposures (
+            id INTEGER PRIMARY KEY,
+            checksum TEXT UNIQUE NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER,
+            mtime_ns INTEGER,
+            caldat TEXT
+        );
+        CREATE INDEX IF NOT EXISTS exposures_path ON exposures (path);
+        CREATE INDEX IF NOT EXISTS exposures_caldat ON exposures (caldat);
+        CREATE TABLE IF NOT EXISTS resolved (
+            exposure INTEGER NOT NULL REFERENCES exposures (id),
+            margin REAL NOT NULL,
+            depth INTEGER NOT NULL,
+            region TEXT NOT NULL,
+            PRIMARY KEY (exposure, margin, depth, region)
+        );
+        CREATE TABLE IF NOT EXISTS shards (
+            exposure INTEGER NOT NULL REFERENCES exposures (id),
+            detector INTEGER NOT NULL,
+            margin REAL NOT NULL,
+            depth INTEGER NOT NULL,
+            region TEXT NOT NULL,
+            shard INTEGER NOT NULL,
+            PRIMARY KEY (exposure, margin, depth, region, detector, shard)
+        );
+        CREATE INDEX IF NOT EXISTS shards_shard ON shards (shard);
+    """
+
+    def __init__(self, path):
+        dirpath = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirpath, exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(self.schema)
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS selected (exposure INTEGER PRIMARY KEY)")
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def checksum(fitsPath, chunkSize=2**20):
+        """MD5 checksum of the file, as reported by the NOIRLab archive."""
+        hasher = hashlib.md5()
+        with open(fitsPath, "rb") as f:
+            for chunk in iter(lambda: f.read(chunkSize), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def calibration_date(fitsPath):
+        """Calibration date, the night, of the exposure as ``YYYY-MM-DD``
+        or `None` when the primary header does not record it."""
+        hdr = read_fits_headers(fitsPath, [0])[0]
+        if "DTCALDAT" in hdr:
+            return str(hdr["DTCALDAT"])
+        elif "DATE-OBS" in hdr:
+            return str(hdr["DATE-OBS"])[:10]
+        return None
+
+    def exposure_id(self, fitsPath):
+        """Return the ID of the exposure in the file, adding it to the index
+        if it was never seen before.
+
+        Parameters
+        ----------
+        fitsPath : `str`
+            Path to the FITS file.
+
+        Returns
+        -------
+        id : `int`
+            ID of the exposure.
+        """
+        path = os.path.abspath(fitsPath)
+        stat = os.stat(path)
+        row = self.connection.execute(
+            "SELECT id FROM exposures WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, stat.st_size, stat.st_mtime_ns)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+
+        checksum = self.checksum(path)
+        with self.connection:
+            row = self.connection.execute(
+                "SELECT id FROM exposures WHERE checksum = ?", (checksum, )
+            ).fetchone()
+            if row is not None:
+                self.connection.execute(
+                    "UPDATE exposures SET path = ?, size = ?, mtime_ns = ? WHERE id = ?",
+                    (path, stat.st_size, stat.st_mtime_ns, row[0])
+                )
+                return row[0]
+            cursor = self.connection.execute(
+                "INSERT INTO exposures (checksum, path, size, mtime_ns, caldat) VALUES (?, ?, ?, ?, ?)",
+                (checksum, path, stat.st_size, stat.st_mtime_ns, self.calibration_date(path))
+            )
+            return cursor.lastrowid
+
+    def _select(self, exposureIds):
+        """Replace the exposures in the temporary selection table."""
+        self.connection.execute("DELETE FROM selected")
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO selected (exposure) VALUES (?)",
+            ((int(i), ) for i in exposureIds)
+        )
+
+    def resolve(self, fitsPaths, detectors=None, pixelMargin=300, depth=7, region="detector", jobs=1):
+        """Resolves IDs of HTM shards overlapping the detectors of the given
+        FITS files, see `resolve_decamraw_htm_shard_ids`.
+
+        Only the exposures not already in the index are read. All of their
+        detectors are resolved and stored, regardless of the requested ones.
+
+        Returns
+        ----------
+        shard_ids : `list`
+            IDs of reference catalog shards overlapping the region.
+        """
+        key = (float(pixelMargin), int(depth), region)
+        exposureIds = [self.exposure_id(f) for f in fitsPaths]
+        self._select(exposureIds)
+        done = set(r[0] for r in self.connection.execute(
+            "SELECT exposure FROM resolved JOIN selected USING (exposure) "
+            "WHERE margin = ? AND depth = ? AND region = ?", key
+        ))
+        missing = {i: f for i, f in zip(exposureIds, fitsPaths) if i not in done}
+
+        if missing:
+            ids, paths = list(missing.keys()), list(missing.values())
+            exposures, hdus, shards = resolve_htm_shard_pairs(paths, None, pixelMargin, depth, region, jobs)
+            exposures = np.asarray(ids, dtype=int)[exposures]
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO shards (exposure, detector, margin, depth, region, shard) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    ((int(e), int(d), *key, int(s)) for e, d, s in zip(exposures, hdus, shards))
+                )
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO resolved (exposure, margin, depth, region) VALUES (?, ?, ?, ?)",
+                    ((i, *key) for i in ids)
+                )
+
+        query = ("SELECT DISTINCT shard FROM shards JOIN selected USING (exposure) "
+                 "WHERE margin = ? AND depth = ? AND region = ?")
+        params = key
+        if detectors is not None:
+            query += f" AND detector IN ({', '.join('?'*len(detectors))})"
+            params += tuple(int(d) for d in detectors)
+        return sorted(r[0] for r in self.connection.execute(query + " ORDER BY shard", params))
+
+    def _filter(self, pixelMargin, depth, region):
+        """SQL condition, and its parameters, selecting the given, not
+        `None`, resolution parameters."""
+        conditions, params = ["1"], []
+        for column, value in (("margin", pixelMargin), ("depth", depth), ("region", region)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        return " AND ".join(conditions), params
+
+    def exposures_touching(self, shardId, pixelMargin=None, depth=None, region=None):
+        """Return paths of the indexed exposures overlapping the shard.
+
+        Parameters
+        ----------
+        shardId : `int`
+            ID of the shard.
+        pixelMargin, depth, region : `int`, `int`, `str` or `None`
+            Only consider shards resolved with the given parameters, see
+            `resolve_decamraw_htm_shard_ids`. When `None` any are used.
+
+        Returns
+        -------
+        paths : `list`
+            Last seen paths to the exposures.
+        """
+        condition, params = self._filter(pixelMargin, depth, region)
+        return [r[0] for r in self.connection.execute(
+            "SELECT DISTINCT path FROM exposures JOIN shards ON exposures.id = shards.exposure "
+            f"WHERE shard = ? AND {condition} ORDER BY path", (int(shardId), *params)
+        )]
+
+    def night_shards(self, caldat, pixelMargin=300, depth=7, region="detector"):
+        """Return IDs of the shards overlapping the indexed exposures of the
+        night.
+
+        Parameters
+        ----------
+        caldat : `str`
+            Calibration date of the night, as ``YYYY-MM-DD``.
+        pixelMargin, depth, region : `int`, `int`, `str` or `None`
+            Only consider shards resolved with the given parameters, see
+            `resolve_decamraw_htm_shard_ids`. When `None` any are used.
+
+        Returns
+        -------
+        shard_ids : `list`
+            Sorted IDs of the shards.
+        """
+        condition, params = self._filter(pixelMargin, depth, region)
+        return [r[0] for r in self.connection.execute(
+            "SELECT DISTINCT shard FROM shards JOIN exposures ON exposures.id = shards.exposure "
+            f"WHERE caldat = ? AND {condition} ORDER BY shard", (caldat, *params)
+        )]
+
+
 ############################################################
+#                       Shard copy
+############################################################
+# ioctl request cloning a file, linux/fs.h
+FICLONE = 0x40049409
+
+SHARD_PLACEMENTS = {
+    "auto": ("hardlink", "reflink", "copy"),
+    "symlink": ("symlink", ),
+    "copy": ("copy", ),
+}
+
+
+def _reflink(src, dst):
+    """Clone the file as a copy-on-write reflink. Linux only, fails when
+    the filesystem does not support it."""
+    import fcntl
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+
+def place_shard(src, dst, link="auto"):
+    """Place the shard file at the destination, unless an identical file
+    is already there.
+
+    Parameters
+    ----------
+    src : `str`
+        Path to the shard file.
+    dst : `str`
+        Path to the destination file.
+    link : `str`
+        How to place the file, one of: ``auto`` - a hardlink, then a
+        reflink, falling back to a copy when the source and the
+        destination do not share a filesystem that supports them,
+        ``symlink`` - a symbolic link, or ``copy`` - always copy.
+
+    Returns
+    -------
+    placement : `str`
+        One of ``identical``, ``hardlink``, ``reflink``, ``symlink`` or
+        ``copy``.
+    """
+    if os.path.lexists(dst):
+        # copies keep the modification times so the comparison
+        # of repeated runs is decided by their stats alone
+        if os.path.exists(dst) and (os.path.samefile(src, dst) or filecmp.cmp(src, dst, shallow=True)):
+            return "identical"
+
+    placements = SHARD_PLACEMENTS[link]
+    tmp = dst + ".part"
+    for placement in placements:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            if placement == "hardlink":
+                os.link(src, tmp)
+            elif placement == "reflink":
+                _reflink(src, tmp)
+            elif placement == "symlink":
+                os.symlink(os.path.abspath(src), tmp)
+            else:
+                shutil.copy2(src, tmp)
+        except OSError:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            if placement == placements[-1]:
+                raise
+            continue
+        os.replace(tmp, dst)
+        return placement
+
+
+def copy_shards(paths, destination, link="auto", jobs=8):
+    """Place the shard files in the destination directory, skipping the
+    ones already there, linking them when possible and copying the rest in
+    parallel, see `place_shard`.
+
+    Parameters
+    ----------
+    paths : `list`
+        Paths to the shard files, duplicates are placed once.
+    destination : `str`
+        Destination directory, created if it does not exist.
+    link : `str`
+        How to place the files, see `place_shard`. Default: ``auto``.
+    jobs : `int`
+        Number of files placed concurrently. Default: 8.
+
+    Returns
+    -------
+    summary : `dict`
+        Number of files and their total size in bytes, per placement.
+    """
+    os.makedirs(destination, exist_ok=True)
+    summary = {placement: [0, 0] for placement in ("identical", "hardlink", "reflink", "symlink", "copy")}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {
+            executor.submit(place_shard, src, os.path.join(destination, os.path.basename(src)), link): src
+            for src in dict.fromkeys(paths)
+        }
+        for future in as_completed(futures):
+            placement = future.result()
+            summary[placement][0] += 1
+            summary[placement][1] += os.path.getsize(futures[future])
+    return summary
+
+
+def format_copy_summary(summary):
+    """Summarize the placed shards and the bytes that were not copied."""
+    placed = ", ".join(f"{n} {placement}" for placement, (n, _) in summary.items() if n)
+    total = sum(size for _, size in summary.values())
+    avoided = total - summary["copy"][1]
+    return (f"Placed {sum(n for n, _ in summary.values())} shards ({placed or 'none'}), "
+            f"avoided copying {avoided/2**20:.1f} of {total/2**20:.1f} MB.")
+
+
+############################################################
+#                     Butler export
+############################################################
+def _indent(line):
+    """Number of leading spaces of the line."""
+    return len(line) - len(line.lstrip(" "))
+
+
+def _is_blank(line):
+    """Blank or comment-only line."""
+    stripped = line.strip()
+    return not stripped or stripped.startswith("#")
+
+
+def _block_items(lines, start, stop):
+    """Split the YAML block sequence, whose first item starts on the given
+    line, into its items.
+
+    Parameters
+    ----------
+    lines : `list`
+        Lines of the YAML file.
+    start : `int`
+        Index of the line of the first item of the sequence.
+    stop : `int`
+        Index of the line at which to stop looking for more items.
+
+    Returns
+    -------
+    items : `list`
+        Pairs of the indices of the first and one past the last line of
+        each item.
+    end : `int`
+        Index of the first line after the sequence.
+    """
+    indent = _indent(lines[start])
+    starts = []
+    end = start
+    for i in range(start, stop):
+        line = lines[i]
+        if _is_blank(line):
+            continue
+        lineIndent = _indent(line)
+        if lineIndent < indent or (lineIndent == indent and not line.lstrip().startswith("-")):
+            break
+        if lineIndent == indent:
+            starts.append(i)
+        end = i + 1
+    return list(zip(starts, starts[1:] + [end])), end
+
+
+def _find_key(lines, start, stop, indent, key):
+    """Index of the line of the mapping key at the given indentation, or
+    `None`. The first line of the mapping may be a sequence item."""
+    for i in range(start, stop):
+        line = lines[i]
+        text = line.lstrip(" -") if i == start else line.lstrip(" ")
+        if text.startswith(key + ":") and (i == start or _indent(line) == indent):
+            return i
+    return None
+
+
+def _next_content(lines, start, stop):
+    """Index of the first non-blank line, or ``stop``."""
+    for i in range(start, stop):
+        if not _is_blank(lines[i]):
+            return i
+    return stop
+
+
+class RefcatExport:
+    """Data Butler Gen 3 exported reference catalog YAML file, indexed by
+    the shard IDs of its dataset records in a single pass over the file.
+
+    The file is split into its preamble, the entries of its ``data`` list
+    and, for the dataset entries, their records, by the indentation of the
+    lines alone, without parsing the YAML. The records can then be trimmed
+    to any set of shards without re-reading the file. Dataset IDs in
+    ``associations`` entries are trimmed alongside their records.
+
+    Parameters
+    ----------
+    yamlpath : `str`
+        Path to the exported reference catalog YAML file.
+    """
+    shardKey = re.compile(r"\bhtm\d+:\s*(\d+)")
+    datasetId = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+    def __init__(self, yamlpath):
+        with open(yamlpath) as f:
+            lines = f.readlines()
+
+        data = next((i for i, line in enumerate(lines) if line.rstrip() == "data:"), None)
+        if data is None:
+            raise ValueError(f"No data section found in {yamlpath}.")
+        self.preamble = lines[:data+1]
+        self.entries = []
+        self.allIds = set()
+
+        first = _next_content(lines, data+1, len(lines))
+        if first == len(lines) or not lines[first].lstrip().startswith("-"):
+            self.epilogue = lines[data+1:]
+            return
+
+        entries, end = _block_items(lines, first, len(lines))
+        self.epilogue = lines[end:]
+        for begin, stop in entries:
+            self.entries.append(self._parse_entry(lines, begin, stop))
+
+    def _parse_entry(self, lines, begin, stop):
+        """Split the entry into its lines preceding, forming and following
+        its records, or dataset IDs, list."""
+        indent = _indent(lines[begin]) + 2
+        typeLine = _find_key(lines, begin, stop, indent, "type")
+        entryType = lines[typeLine].split(":", 1)[1].strip() if typeLine is not None else None
+        listKey = {"dataset": "records", "associations": "dataset_ids"}.get(entryType)
+        keyLine = None if listKey is None else _find_key(lines, begin, stop, indent, listKey)
+        itemsLine = stop if keyLine is None else _next_content(lines, keyLine+1, stop)
+        if itemsLine == stop or not lines[itemsLine].lstrip().startswith("-"):
+            return {"type": None, "lines": lines[begin:stop]}
+
+        items, end = _block_items(lines, itemsLine, stop)
+        entry = {"type": entryType, "head": lines[begin:itemsLine], "tail": lines[end:stop], "items": []}
+        for itemBegin, itemEnd in items:
+            text = "".join(lines[itemBegin:itemEnd])
+            if entryType == "dataset":
+                shard = self.shardKey.search(text)
+                ids = set(self.datasetId.findall(text))
+                self.allIds.update(ids)
+                entry["items"].append((int(shard.group(1)) if shard else None, ids, text))
+            else:
+                match = self.datasetId.search(text)
+                entry["items"].append((match.group(0) if match else None, text))
+        return entry
+
+    @property
+    def shard_ids(self):
+        """IDs of all of the shards in the file."""
+        return sorted(set(shard for entry in self.entries if entry["type"] == "dataset"
+                          for shard, _, _ in entry["items"] if shard is not None))
+
+    def trim(self, shard_ids):
+        """Return the file trimmed down to the records of the given shards.
+
+        Dataset entries without any of the shards are dropped, all of the
+        other entries are kept as they are.
+
+        Parameters
+        ----------
+        shard_ids : `list`
+            IDs of the shards to keep.
+
+        Returns
+        -------
+        trimmed_yaml : `str`
+            A valid YAML string, trimmed down version of the file.
+        """
+        shard_ids = set(int(s) for s in shard_ids)
+        keptIds = set()
+        for entry in self.entries:
+            if entry["type"] == "dataset":
+                for shard, ids, _ in entry["items"]:
+                    if shard in shard_ids:
+                        keptIds.update(ids)
+
+        out = list(self.preamble)
+        for entry in self.entries:
+            if entry["type"] == "dataset":
+                items = [text for shard, _, text in entry["items"] if shard in shard_ids]
+            elif entry["type"] == "associations":
+                items = [text for uuid, text in entry["items"]
+                         if uuid in keptIds or uuid not in self.allIds]
+            else:
+                out.extend(entry["lines"])
+                continue
+            if items:
+                out.extend(entry["head"])
+                out.extend(items)
+                out.extend(entry["tail"])
+        out.extend(self.epilogue)
+        return "".join(out)
+
+
 def trim_gen3_exported_refcat_yaml(yamlpath, shard_ids):
     """Extract the header and the entry for each of the given shard IDs from
     the Data Butler Gen 3 exported reference catalog YAML file.
 
+    The file is read once, see `RefcatExport`, use it directly to trim the
+    same file to different sets of shards.
+
     Parameters
     ----------
     yamlpath : `str`
@@ -291,23 +1476,36 @@ def trim_gen3_exported_refcat_yaml(yamlpath, shard_ids):
     trimmed_yaml : `str`
         A valid YAML string, trimmed down version of the given YAML.
     """
-    metadata_match = subprocess.run(["head", "-19", yamlpath],
-                                    capture_output=True)
-    newyaml = metadata_match.stdout.decode()
-
-    for shard_id in shard_ids:
-        # this could be a bit problematic because it
-        # assumes htm - but no other refcats exist
-        # anyhow, so whatever
-        match = subprocess.run(
-            ["grep", f"\- htm7: {shard_id}", "-B", "3", "-A", "2", yamlpath],
-            capture_output=True
-        )
-        newyaml += match.stdout.decode()
+    return RefcatExport(yamlpath).trim(shard_ids)
 
-    return newyaml
 
-def main(files, ref_dataset_name, indexer, refcatLoc, detectors):
+############################################################
+#                         Main
+############################################################
+def _stack_config(ref_dataset_name, indexer):
+    """Import the stack and return the reference catalog configuration."""
+    deferred_import("lsst.meas.algorithms", "measAlgs")
+    deferred_import("lsst.afw.image", "afwImage")
+    deferred_import("lsst.afw.geom", "afwGeom")
+    deferred_import("lsst.pipe.base", "pipeBase")
+    deferred_import("lsst.geom", "geom")
+    deferred_import("astropy.io.fits", "fitsio")
+    deferred_import("astropy.wcs", "awcs")
+
+    refCatConf = measAlgs.DatasetConfig()
+    refCatConf.ref_dataset_name  = ref_dataset_name
+    refCatConf.indexer = indexer
+    return refCatConf
+
+
+def _resolve_stack_shard_ids(fitsPath, ref_dataset_name, indexer, detectors, pixelMargin):
+    """Resolve the shards of a file with the stack, in a worker process."""
+    refCatConf = _stack_config(ref_dataset_name, indexer)
+    return resolve_decamraw_shard_ids(refCatConf, fitsPath, detectors=detectors, pixelMargin=pixelMargin)
+
+
+def main(files, ref_dataset_name, indexer, refcatLoc, detectors, useStack=False, region="detector",
+         pixelMargin=300, index=None, jobs=1):
     """Identify IDs of reference catalog shards that overlap the given image.
 
     Convenience wrapper for the program's purpose so it can be called from the
@@ -327,6 +1525,20 @@ def main(files, ref_dataset_name, indexer, refcatLoc, detectors):
         List of detectors for which the shard IDs
         will be resolved for. If `None` uses all of the
         image-like HDUs.
+    useStack : `bool`
+        Resolve the shards with the Rubin stack indexer, one detector at a
+        time. By default the HTM shards are resolved without the stack, see
+        `resolve_decamraw_htm_shard_ids`.
+    region : `str`
+        Sky region of the detectors the shards are resolved for, see
+        `resolve_decamraw_htm_shard_ids`. Ignored by the stack resolver.
+    pixelMargin : `int`
+        Bounding box padding, in pixels. Default: 300.
+    index : `ShardIndex` or `None`
+        Index of previously resolved exposures, see `ShardIndex`. Ignored by
+        the stack resolver.
+    jobs : `int`
+        Number of worker processes the files are split between. Default: 1.
 
     Returns
     -------
@@ -338,26 +1550,28 @@ def main(files, ref_dataset_name, indexer, refcatLoc, detectors):
     shard_paths : `list`
         An absolute path to the shard files.
     """
-    deferred_import("lsst.meas.algorithms", "measAlgs")
-    deferred_import("lsst.afw.image", "afwImage")
-    deferred_import("lsst.afw.geom", "afwGeom")
-    deferred_import("lsst.pipe.base", "pipeBase")
-    deferred_import("lsst.geom", "geom")
-    deferred_import("astropy.io.fits", "fitsio")
-    deferred_import("astropy.wcs", "awcs")
-
-    refCatConf = measAlgs.DatasetConfig()
-    refCatConf.ref_dataset_name  = ref_dataset_name
-    refCatConf.indexer = indexer
-
-    #calexp = afwImage.ExposureF(aargs.img)
-    #shard_ids = resolve_calexp_shard_ids(refCatConf, calexp)
-    shard_ids = []
-    for f in files:
-        shard_ids.extend(resolve_decamraw_shard_ids(refCatConf, f, detectors=detectors))
-    # each shard_id list for each file is de-duplicated itself
-    # we need to deduplicate the total set too however.
-    shard_ids = list(set(shard_ids))
+    if not useStack and indexer == "HTM":
+        refCatConf = None
+        shard_ids = resolve_decamraw_htm_shard_ids(files, detectors=detectors, pixelMargin=pixelMargin,
+                                                   region=region, index=index, jobs=jobs)
+    else:
+        refCatConf = _stack_config(ref_dataset_name, indexer)
+
+        #calexp = afwImage.ExposureF(aargs.img)
+        #shard_ids = resolve_calexp_shard_ids(refCatConf, calexp)
+        args = (files, itertools.repeat(ref_dataset_name), itertools.repeat(indexer),
+                itertools.repeat(detectors), itertools.repeat(pixelMargin))
+        shard_ids = set()
+        if jobs > 1 and len(files) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                for ids in pool.map(_resolve_stack_shard_ids, *args):
+                    shard_ids.update(ids)
+        else:
+            for ids in map(_resolve_stack_shard_ids, *args):
+                shard_ids.update(ids)
+        # each shard_id list for each file is de-duplicated itself
+        # we need to deduplicate the total set too however.
+        shard_ids = list(shard_ids)
 
     shard_names = []
     for sid in shard_ids:
@@ -385,7 +1599,8 @@ if __name__=="__main__":
     ##########
     parser.add_argument(
         "path",
-        help="Path to an image or a directory of images."
+        help="Path to an image or a directory of images. Not required by the index queries.",
+        nargs="?", default=None
     )
 
     ##########
@@ -415,6 +1630,60 @@ if __name__=="__main__":
         ),
         nargs="?", default=None, dest="detectors"
     )
+    parser.add_argument(
+        "--use-stack",
+        help=(
+            "Resolve the shards with the Rubin stack indexer. By default HTM shards "
+            "are resolved with a built-in implementation that does not need the stack."
+        ),
+        action="store_true", dest="useStack"
+    )
+    parser.add_argument(
+        "--region",
+        help=(
+            "Sky region the shards are resolved for: the exact polygon of each detector "
+            "(detector), the convex hull of the detectors of each exposure (exposure) or "
+            "the circle circumscribing each detector (circle). Default: detector"
+        ),
+        choices=("detector", "exposure", "circle"), default="detector", dest="region"
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        help="Number of worker processes the files are split between. Default: 1",
+        type=int, default=1, dest="jobs"
+    )
+    parser.add_argument(
+        "--pixel-margin",
+        help="Padding, in pixels, of the detector bounding boxes. Default: 300",
+        nargs="?", default=300, type=int, dest="pixelMargin"
+    )
+
+    ##########
+    # Shard index arguments
+    ##########
+    parser.add_argument(
+        "--index",
+        help=(
+            "Path to an SQLite index of the shards overlapping the previously resolved "
+            "exposures, created if it does not exist. Only the exposures missing from it "
+            "are resolved. HTM shards are the same for all catalogs of the same depth, so "
+            "the index can be shared between them."
+        ),
+        nargs="?", default=None, dest="index"
+    )
+    parser.add_argument(
+        "--which-exposures",
+        help="Print the indexed exposures overlapping the given shard ID and exit.",
+        nargs="?", default=None, type=int, dest="whichExposures"
+    )
+    parser.add_argument(
+        "--night-shards",
+        help=(
+            "Use the shards overlapping the indexed exposures of the given night, "
+            "YYYY-MM-DD, instead of resolving them from the path."
+        ),
+        nargs="?", default=None, dest="nightShards"
+    )
 
     ##########
     # Data extraction arguments
@@ -424,6 +1693,21 @@ if __name__=="__main__":
         help="Copy the shards to the given destination, assumed $PWD",
         nargs="?", default=False, dest="copy"
     )
+    parser.add_argument(
+        "--link",
+        help=(
+            "How the shards are placed at the destination: a hardlink or a reflink, "
+            "copying them when neither is possible (auto), a symbolic link (symlink) "
+            "or always a copy (copy). Identical shards already at the destination are "
+            "skipped. Default: auto"
+        ),
+        choices=tuple(SHARD_PLACEMENTS), default="auto", dest="link"
+    )
+    parser.add_argument(
+        "--copy-jobs",
+        help="Number of shards placed concurrently. Default: 8",
+        type=int, default=8, dest="copyJobs"
+    )
     parser.add_argument(
         "--import-file",
         help=(
@@ -440,23 +1724,46 @@ if __name__=="__main__":
     copyLoc = resolve_input_meaning(aargs.copy, os.path.join(os.getcwd(), aargs.ref_dataset_name))
     refcatLoc = resolve_input_meaning(aargs.refcatLoc, os.getcwd())
     importFile = resolve_input_meaning(aargs.import_file, os.getcwd())
+    detectors = None
     if aargs.detectors is not None:
-        detectors = [int(i) for i in aargs.detectors.split()]
-
-    if os.path.isfile(aargs.path):
-        files = [aargs.path, ]
-    elif os.path.isdir(aargs.path):
-        files = glob.glob(f"{aargs.path}/*.fits*")
+        detectors = [int(i) for i in aargs.detectors.replace(",", " ").split()]
+
+    index = ShardIndex(aargs.index) if aargs.index else None
+    if aargs.whichExposures is not None or aargs.nightShards is not None:
+        if index is None:
+            raise ValueError("Index queries require an index, provide --index.")
+        if aargs.useStack:
+            raise ValueError("Index queries are not supported with --use-stack.")
+
+    if aargs.whichExposures is not None:
+        for path in index.exposures_touching(aargs.whichExposures, aargs.pixelMargin, 7, aargs.region):
+            print(path)
+        raise SystemExit
+
+    if aargs.nightShards is not None:
+        ids = index.night_shards(aargs.nightShards, aargs.pixelMargin, 7, aargs.region)
+        names = [get_shard_filename(None, sid) for sid in ids]
+        paths = [get_shard_filepath(None, aargs.refcatLoc, sid) for sid in ids] if aargs.refcatLoc else []
     else:
-        raise ValueError("Expected path to file or a directory, got {aargs.path} instead.")
-
-    ids, names, paths = main(
-        files=files,
-        ref_dataset_name=aargs.ref_dataset_name,
-        indexer=aargs.indexer,
-        refcatLoc=aargs.refcatLoc,
-        detectors=aargs.detectors
-    )
+        if aargs.path is not None and os.path.isfile(aargs.path):
+            files = [aargs.path, ]
+        elif aargs.path is not None and os.path.isdir(aargs.path):
+            files = glob.glob(f"{aargs.path}/*.fits*")
+        else:
+            raise ValueError(f"Expected path to file or a directory, got {aargs.path} instead.")
+
+        ids, names, paths = main(
+            files=files,
+            ref_dataset_name=aargs.ref_dataset_name,
+            indexer=aargs.indexer,
+            refcatLoc=aargs.refcatLoc,
+            detectors=detectors,
+            useStack=aargs.useStack,
+            region=aargs.region,
+            pixelMargin=aargs.pixelMargin,
+            index=index,
+            jobs=aargs.jobs
+        )
     print(build_table(ids, names, paths))
 
     # main() returns empty list when no shards were identified or not enough
@@ -469,9 +1776,8 @@ if __name__=="__main__":
             "reference catalog directory. Provide --refcat-path."
         )
     elif copyLoc and refcatLoc:
-        if not os.path.exists(copyLoc):
-            os.makedirs(copyLoc, exist_ok=True)
-        [shutil.copy(shard, os.path.abspath(copyLoc)) for shard in paths]
+        summary = copy_shards(paths, os.path.abspath(copyLoc), link=aargs.link, jobs=aargs.copyJobs)
+        print(format_copy_summary(summary))
     else:
         # no copying was requested
         pass
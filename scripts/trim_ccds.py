@@ -1,12 +1,25 @@
 #!/usr/bin/env python
+import io
 import os
+import sys
 import glob
+import json
+import hashlib
+import functools
+import queue
 import argparse
-from collections import OrderedDict
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 
 from astropy.io import fits
+import numpy as np
 import yaml
 
+from recipe_utils import fits_data_size
+
 
 ############################################################
 #                         Utilities
@@ -25,6 +38,10 @@ class HDULookup:
     with either index or the name of the detector in question to
     retrieve the opposite. 
 
+    Bulk translations, `to_names`, `to_ids` and `to_positions`, are
+    vectorized over array-based columns of the detector indices, names,
+    positions of the HDUs in the HDUList and their types.
+
     Parameters
     ----------
     idx_name_map : `dict` or `list`
@@ -32,6 +49,7 @@ class HDULookup:
         pair ``detector`` and ``full_name`` values. On the example of
         DECam:
         ``[(1, 'S1'), (2, 'S2') ...]``
+        The order of the pairs is the order of the HDUs in the file.
     hdutypes : `list`
         List of Astropy class names for the header type. Used to
         determine if the HDU is image-like or not. 
@@ -43,7 +61,17 @@ class HDULookup:
             self.idx_name = {i:n for i,n in idx_name_map}
 
         self.name_idx = {n: i for i,n in self.idx_name.items()}
-        self.types = hdutypes
+        self.types = list(hdutypes)
+
+        # columns, one row per HDU in the order of the HDUList
+        self.idxs = np.array(list(self.idx_name.keys()))
+        self.names = np.array(list(self.idx_name.values()), dtype=str)
+        self.positions = np.arange(len(self.idxs))
+        self.imagelike = np.array(["ImageHDU" in t for t in self.types], dtype=bool)
+
+        # sort orders used to resolve many IDs at once
+        self._idx_order = np.argsort(self.idxs, kind="stable")
+        self._name_order = np.argsort(self.names, kind="stable")
 
     @classmethod
     def fromHDUList(cls, hdul):
@@ -71,7 +99,7 @@ class HDULookup:
         return cls(idx_name_map, hdutypes)
 
     @classmethod
-    def fromDECamHDUList(cls, hdul):
+    def fromDECamHDUList(cls, hdul, layouts=None, protected=None):
         """Create an HDULookup instance from an DECam
         `~astropy.io.fits.HDUList`.
 
@@ -83,31 +111,184 @@ class HDULookup:
         the detector designations when trimming
         the exported YAMLs. 
 
+        Parameters
+        ----------
+        hdul : `~astropy.io.fits.HDUList`
+            HDUList, preferably lazy loaded.
+        layouts : `dict` or `None`
+            Cache of lookups keyed by their layout fingerprint, see
+            `layout_fingerprint`. New lookups are added to the cache.
+        protected : `list` or `None`
+            IDs of the detectors the caller relies on. A cached lookup
+            is used only when the headers of their HDUs match it, see
+            `validate`, so that only those headers are read. When `None`,
+            all the headers are checked.
+
         Returns
         -------
         hdumap : `HDULookup`
             Map of logical detector indices and their full names.
         """
-        idx_name_map, hdutypes = [], []
-        unparsable_counter = len(hdul)
-        for hdu in hdul:
-            hdutype = hdu.__class__.__name__
+        fingerprint = cls.layout_fingerprint(hdul[0].header)
+        if layouts is not None and fingerprint in layouts:
+            hdumap = layouts[fingerprint]
+            try:
+                positions = None if protected is None else hdumap.to_positions(protected)
+            except KeyError:
+                pass
+            else:
+                if hdumap.validate(hdul, positions):
+                    return hdumap
+
+        hdutypes = [hdu.__class__.__name__ for hdu in hdul]
+        hdumap = cls.fromDECamHeaders(hdutypes, [hdu.header for hdu in hdul])
+        if layouts is not None and fingerprint is not None:
+            layouts[fingerprint] = hdumap
+        return hdumap
+
+    @classmethod
+    def fromDECamFile(cls, path, layouts=None):
+        """Create an HDULookup instance from the headers of a DECam FITS
+        file, see `read_headers`.
+
+        Parameters
+        ----------
+        path : `str`
+            Path to the FITS file.
+        layouts : `dict` or `None`
+            Cache of lookups keyed by their layout fingerprint. When the
+            file's fingerprint is found in the cache only its primary
+            header is read. New lookups are added to the cache.
+
+        Returns
+        -------
+        hdumap : `HDULookup`
+            Map of logical detector indices and their full names.
+        """
+        headers = read_headers(path)
+        hdutype, primary = next(headers)
+        fingerprint = cls.layout_fingerprint(primary)
+        if layouts is not None and fingerprint in layouts:
+            headers.close()
+            return layouts[fingerprint]
+
+        hdutypes, hdrs = [hdutype], [primary]
+        for hdutype, header in headers:
+            hdutypes.append(hdutype)
+            hdrs.append(header)
+
+        hdumap = cls.fromDECamHeaders(hdutypes, hdrs)
+        if layouts is not None and fingerprint is not None:
+            layouts[fingerprint] = hdumap
+        return hdumap
+
+    @classmethod
+    def fromDECamHeaders(cls, hdutypes, headers):
+        """Create an HDULookup instance from the DECam HDU headers.
+
+        Parameters
+        ----------
+        hdutypes : `list`
+            Astropy class names of the HDUs.
+        headers : `list`
+            Headers of the HDUs, in the order they appear in the file.
+
+        Returns
+        -------
+        hdumap : `HDULookup`
+            Map of logical detector indices and their full names.
+        """
+        idx_name_map = []
+        unparsable_counter = len(headers)
+        for hdutype, header in zip(hdutypes, headers):
             try:
-                idx = hdu.header["CCDNUM"]
-                name = hdu.header["DETPOS"]
-            except KeyError as e:
+                idx = header["CCDNUM"]
+                name = header["DETPOS"]
+            except KeyError:
                 if hdutype == "PrimaryHDU":
                     category = (0, "PrimaryHDU")
                 else:
                     unparsable_counter += 1
-                    name, _, _, _, _, _ = hdu._summary()
-                    category = (unparsable_counter, name)
+                    category = (unparsable_counter, header.get("EXTNAME", ""))
             else:
                 category = (idx, name)
 
             idx_name_map.append(category)
-            hdutypes.append(hdutype)
-        return cls(idx_name_map, hdutypes)
+        return cls(idx_name_map, list(hdutypes))
+
+    @classmethod
+    def fromDict(cls, data):
+        """Create an HDULookup from its `toDict` representation."""
+        return cls([tuple(pair) for pair in data["idx_name_map"]], data["hdutypes"])
+
+    def toDict(self):
+        """Represent the lookup as a JSON serializable dictionary."""
+        return {"idx_name_map": [(int(i), str(n)) for i, n in zip(self.idxs, self.names)],
+                "hdutypes": self.types}
+
+    @staticmethod
+    def layout_fingerprint(header):
+        """Fingerprint of the HDU layout of a file, computed from its
+        primary header.
+
+        Files of the same instrument with the same number of extensions
+        are assumed to share the layout. The cached lookups are checked
+        against the HDU headers, see `validate`.
+
+        Parameters
+        ----------
+        header : `fits.Header`
+            Primary header.
+
+        Returns
+        -------
+        fingerprint : `str` or `None`
+            The fingerprint, `None` when the header does not contain
+            the ``INSTRUME`` and ``NEXTEND`` keywords.
+        """
+        if "INSTRUME" not in header or "NEXTEND" not in header:
+            return None
+        return f"{header['INSTRUME']}:{header['NEXTEND']}"
+
+    def validate(self, hdul, positions=None):
+        """Check that the lookup describes the HDUs of the given HDUList.
+
+        Each checked HDU whose header contains the ``CCDNUM`` and ``DETPOS``
+        keywords must have the same ``detector`` number and ``full_name``
+        at its position in the lookup.
+
+        Parameters
+        ----------
+        hdul : `~astropy.io.fits.HDUList`
+            HDUList, preferably lazy loaded.
+        positions : `list` or `None`
+            Positions of the detector HDUs to check, their headers must
+            contain the keywords. When `None`, all of the HDUs are checked
+            and their number must match too.
+
+        Returns
+        -------
+        valid : `bool`
+            `True` if the lookup matches the headers.
+        """
+        detectors = positions is not None
+        if not detectors:
+            if len(hdul) != len(self.idxs):
+                return False
+            positions = self.positions
+
+        for pos in positions:
+            try:
+                header = hdul[pos].header
+            except IndexError:
+                return False
+            if "CCDNUM" not in header or "DETPOS" not in header:
+                if detectors:
+                    return False
+                continue
+            if self.idxs[pos] != header["CCDNUM"] or self.names[pos] != header["DETPOS"]:
+                return False
+        return True
 
     def __getitem__(self, val):
         try:
@@ -115,66 +296,624 @@ class HDULookup:
         except KeyError:
             return self.name_idx[val]
 
-    def to_names(self, ids):
-        """Convert iterable of IDs into the detector name."""
-        names = []
-        for i in ids:
-            # assume it's an logical id, if it isn't it must be a name
-            # else, translate and append
-            is_name = False
-            try:
-                tmpi = int(i)
-            except ValueError:
-                is_name = True
-            else:
-                # id is logical indexm, translate to name
-                names.append(self[i])
+    def _resolve(self, ids):
+        """Resolve IDs, logical detector indices or full names, into the
+        rows of the lookup's columns.
 
-            # id is a name already, if exists in the map store it
-            # else raise Key Error
-            if is_name and i in self.name_idx:
-                names.append(i)
-            else:
-                raise KeyError(f"No ID {i} in the detector ID-name map.")
+        Raises
+        ------
+        KeyError
+            When any of the IDs is not in the lookup.
+        """
+        ids = np.atleast_1d(np.asarray(ids)).astype(str)
+        rows = np.full(len(ids), -1)
+
+        # assume numerical IDs are logical ids, everything else is a name
+        is_idx = np.char.isdigit(ids)
+        for mask, column, order in ((is_idx, self.idxs, self._idx_order),
+                                    (~is_idx, self.names, self._name_order)):
+            if not mask.any():
+                continue
+            keys = ids[mask].astype(int) if column is self.idxs else ids[mask]
+            sorted_column = column[order]
+            found = np.searchsorted(sorted_column, keys).clip(max=len(column)-1)
+            matched = sorted_column[found] == keys
+            rows[np.flatnonzero(mask)[matched]] = order[found[matched]]
+
+        if (rows < 0).any():
+            raise KeyError(f"No ID {ids[rows < 0][0]} in the detector ID-name map.")
+        return rows
 
-        return names
+    def to_names(self, ids):
+        """Convert iterable of IDs into an array of detector names."""
+        return self.names[self._resolve(ids)]
 
     def to_ids(self, ids):
-        """Convert iterable of IDs into logical detector index."""
-        idxs = []
-        for i in ids:
-            # assume it's an logical id, check it exists in the map and append
-            # otherwise it's a name, so translate and append 
-            try:
-                tmpi = int(i)
-            except ValueError:
-                idxs.append(self[i])
-            else:
-                if i in self.idx_name:
-                    idxs.append(i)
-        return idxs
+        """Convert iterable of IDs into an array of logical detector
+        indices."""
+        return self.idxs[self._resolve(ids)]
+
+    def to_positions(self, ids):
+        """Convert iterable of IDs into an array of positions of their
+        HDUs in the HDUList."""
+        return self.positions[self._resolve(ids)]
 
     def get_imagelike_idxs(self):
         """Return all image-like logical detector indices."""
-        idxs = []
-        for hdutype, (name, idx) in zip(self.types, self.name_idx.items()):
-            if "ImageHDU" in hdutype:
-                idxs.append(idx)
-        return idxs
+        return self.idxs[self.imagelike]
 
     def get_imagelike_names(self):
         """Return all image-lige detector full names."""
-        idxs = self.get_imagelike_idxs()
-        return [self.idx_name[i] for i in idxs]
+        return self.names[self.imagelike]
+
+    def get_imagelike_positions(self):
+        """Return positions of all image-like HDUs in the HDUList."""
+        return self.positions[self.imagelike]
+
+
+def read_headers(path):
+    """Yield the Astropy class name and the header of each HDU in the
+    FITS file without reading its data.
+
+    Headers are parsed directly from the file, seeking over the data
+    units, so that neither the HDU objects are constructed nor the
+    compressed data read. Compressed (gzip, bzip2) files are read via
+    a lazy loaded `~astropy.io.fits.HDUList` instead.
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the FITS file.
+
+    Yields
+    ------
+    hdutype : `str`
+        Astropy class name of the HDU.
+    header : `fits.Header`
+        Header of the HDU.
+    """
+    if path.endswith((".gz", ".bz2", ".zip")):
+        with fits.open(path, lazy_load_hdus=True) as hdul:
+            for hdu in hdul:
+                yield hdu.__class__.__name__, hdu.header
+        return
+
+    with open(path, "rb") as f:
+        while True:
+            try:
+                header = fits.Header.fromfile(f)
+            except EOFError:
+                return
+
+            if header.get("SIMPLE", False):
+                hdutype = "PrimaryHDU"
+            elif header.get("XTENSION") == "IMAGE":
+                hdutype = "ImageHDU"
+            elif header.get("XTENSION") == "BINTABLE":
+                hdutype = "CompImageHDU" if header.get("ZIMAGE", False) else "BinTableHDU"
+            else:
+                hdutype = "TableHDU"
+            yield hdutype, header
+            f.seek(fits_data_size(header), os.SEEK_CUR)
+
+
+# Cache of the HDU lookups keyed by their layout fingerprint, shared by all
+# the files processed by this process. See HDULookup.layout_fingerprint.
+HDU_LAYOUTS = {}
+
+
+def load_hdu_layouts(path):
+    """Populate `HDU_LAYOUTS` from the file written by `save_hdu_layouts`,
+    if it exists."""
+    if path is None or not os.path.isfile(path):
+        return
+    with open(path) as f:
+        for fingerprint, data in json.load(f).items():
+            HDU_LAYOUTS[fingerprint] = HDULookup.fromDict(data)
+
+
+def save_hdu_layouts(path):
+    """Write the `HDU_LAYOUTS` to a JSON file."""
+    with open(path, "w") as f:
+        json.dump({k: v.toDict() for k, v in HDU_LAYOUTS.items()}, f, indent=1)
+
+
+def file_record(path, checksum=True):
+    """Describe the file's content and state on disk.
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the file.
+    checksum : `bool`
+        Compute the MD5 checksum of the file's content.
+
+    Returns
+    -------
+    record : `dict`
+        File ``size``, modification time ``mtime_ns`` and, optionally,
+        its ``md5`` checksum.
+    """
+    stat = os.stat(path)
+    record = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if checksum:
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                md5.update(chunk)
+        record["md5"] = md5.hexdigest()
+    return record
+
+
+class TrimManifest:
+    """A record of previously trimmed files that lets the unchanged files be
+    skipped when trimming is repeated.
+
+    Each trimmed file is recorded under its name along with the checksum of
+    its input, the checksum of the trimmed output and a digest of the
+    parameters, the protected detectors and the compression arguments, it
+    was trimmed with. A file is up to date when the parameters match, the
+    output file was not modified since, and the input content matches either
+    the recorded input or the recorded output. The latter is the case when
+    the files are trimmed in place. Checksums are computed only when the
+    file size or modification time do not match the recorded ones.
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the manifest file.
+    entries : `dict` or `None`
+        Records of the trimmed files, keyed by the file name.
+    """
+    filename = ".trim_manifest.json"
+
+    def __init__(self, path, entries=None):
+        self.path = path
+        self.entries = {} if entries is None else entries
+
+    @classmethod
+    def fromDirectory(cls, dirpath):
+        """Load the manifest stored in the given directory, or create an
+        empty one if there is none.
+        """
+        path = os.path.join(dirpath, cls.filename)
+        if not os.path.isfile(path):
+            return cls(path)
+        with open(path) as f:
+            return cls(path, json.load(f))
+
+    @staticmethod
+    def params_digest(protected, **kwargs):
+        """Digest of the parameters that determine the trimmed content."""
+        params = {
+            "protected": sorted(str(p) for p in protected),
+            "kwargs": sorted((k, str(v)) for k, v in kwargs.items())
+        }
+        return hashlib.md5(json.dumps(params).encode()).hexdigest()
+
+    def is_current(self, path, fpath, params):
+        """Check if the trimmed file is up to date with its input.
+
+        Parameters
+        ----------
+        path : `str`
+            Path to the input file.
+        fpath : `str`
+            Path to the trimmed file.
+        params : `str`
+            Digest of the trimming parameters, see `params_digest`.
+
+        Returns
+        -------
+        current : `bool`
+            `True` when the file does not need to be trimmed again.
+        """
+        entry = self.entries.get(os.path.basename(fpath))
+        if entry is None or entry["params"] != params or not os.path.isfile(fpath):
+            return False
+
+        return (self._matches(fpath, [entry["output"]])
+                and self._matches(path, [entry["input"], entry["output"]]))
+
+    @staticmethod
+    def _matches(path, records):
+        """Check if the file matches any of the records, comparing the
+        checksums only if none of the file sizes and modification times do.
+        """
+        stat = file_record(path, checksum=False)
+        if any((stat["size"], stat["mtime_ns"]) == (r["size"], r["mtime_ns"]) for r in records):
+            return True
+        md5 = file_record(path)["md5"]
+        return any(md5 == r["md5"] for r in records)
+
+    def update(self, fpath, params, input_record, output_record):
+        """Record a newly trimmed file."""
+        self.entries[os.path.basename(fpath)] = {
+            "params": params,
+            "input": input_record,
+            "output": output_record,
+        }
+
+    def save(self):
+        """Write the manifest to disk, replacing the previous one."""
+        tmppath = self.path + ".tmp"
+        with open(tmppath, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmppath, self.path)
+
+
+# Map of FITS BITPIX values to the on-disk numpy dtype
+BITPIX2DTYPE = {8: "uint8", 16: "int16", 32: "int32", 64: "int64", -32: "float32", -64: "float64"}
+
+
+def image_geometry(header):
+    """Return the shape and the data type of the image described by the
+    given header.
+
+    The data type matches the one Astropy would return when reading the
+    image, including the scaling implied by ``BZERO`` and ``BSCALE``.
+
+    Parameters
+    ----------
+    header : `fits.Header`
+        Image header.
+
+    Returns
+    -------
+    shape : `tuple`
+        Shape of the image, in numpy axis order.
+    dtype : `numpy.dtype`
+        Data type of the image.
+    """
+    naxis = header["NAXIS"]
+    shape = tuple(header[f"NAXIS{i}"] for i in range(naxis, 0, -1))
+    bitpix = header["BITPIX"]
+    bzero, bscale = header.get("BZERO", 0), header.get("BSCALE", 1)
+
+    dtype = np.dtype(BITPIX2DTYPE[bitpix])
+    if bitpix > 8 and bscale == 1 and bzero == 2**(bitpix-1):
+        # Astropy's default, uint=True, reads these as unsigned ints
+        dtype = np.dtype(f"uint{bitpix}")
+    elif bitpix > 0 and (bzero != 0 or bscale != 1):
+        dtype = np.dtype("float32") if bitpix < 32 else np.dtype("float64")
+
+    return shape, dtype
+
+
+# Keywords describing the structure of an uncompressed image. Their compressed
+# counterparts are taken from the compressed zeros template instead.
+IMAGE_STRUCTURE_KEYS = {"SIMPLE", "XTENSION", "BITPIX", "NAXIS", "PCOUNT", "GCOUNT", "EXTEND",
+                        "BZERO", "BSCALE", "CHECKSUM", "DATASUM"}
+
+
+@functools.lru_cache(maxsize=16)
+def _compressed_zeros_template(shape, dtype, compkwargs):
+    """Compress an image of zeros once and return the header and the tile
+    table of the resulting binary table HDU.
+
+    Parameters
+    ----------
+    shape : `tuple`
+        Shape of the image.
+    dtype : `numpy.dtype`
+        Data type of the image.
+    compkwargs : `tuple`
+        Sorted ``(key, value)`` pairs of `fits.CompImageHDU` init parameters.
+
+    Returns
+    -------
+    header : `fits.Header`
+        Binary table header with no image specific keywords.
+    data : `fits.FITS_rec`
+        Compressed tiles.
+    """
+    template = fits.CompImageHDU(data=np.zeros(shape, dtype=dtype), **dict(compkwargs))
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), template]).writeto(buffer)
+    buffer.seek(0)
+
+    with fits.open(buffer, disable_image_compression=True) as hdul:
+        header = hdul[1].header.copy()
+        data = hdul[1].data
+    header.remove("EXTNAME", ignore_missing=True)
+    return header, data
+
+
+def compressed_zeros_from_header(header, **kwargs):
+    """Create a compressed HDU of zeros with the shape, data type and the
+    keywords of the image described by the given header.
+
+    The image is compressed only once per unique shape, data type and
+    compression parameters. Afterwards, the compressed tiles are reused
+    and only the header is created anew, so the image data is neither
+    read, decompressed nor compressed.
+
+    Parameters
+    ----------
+    header : `fits.Header`
+        Image header.
+    kwargs : `dict`
+        Optional `fits.CompImageHDU` init parameters.
+
+    Returns
+    -------
+    hdu : `fits.BinTableHDU`
+        Compressed image HDU, as represented on disk. When read back, Astropy
+        recognizes it as a `fits.CompImageHDU`.
+    """
+    shape, dtype = image_geometry(header)
+    tblheader, data = _compressed_zeros_template(shape, dtype, tuple(sorted(kwargs.items())))
+
+    tblheader = tblheader.copy()
+    for card in header.cards:
+        key = card.keyword
+        if key in IMAGE_STRUCTURE_KEYS or (key.startswith("NAXIS") and key[5:].isdigit()):
+            continue
+        tblheader.append(card, end=True)
+
+    hdu = fits.BinTableHDU(data=data, header=tblheader)
+    # table HDUs drop the image scaling keywords on init, restore them
+    for key in ("BZERO", "BSCALE"):
+        if key in tblheader:
+            hdu.header[key] = tblheader[key]
+    return hdu
 
 
 ############################################################
 #                         Trimmers
 ############################################################
-def trim_exported_yaml(path, idxs, fullnames, filters=None, writeto=None):
+def _read_node(first, events):
+    """Collect the events of the YAML node that starts with the given
+    event.
+
+    Parameters
+    ----------
+    first : `yaml.Event`
+        First event of the node.
+    events : `iterator`
+        Remaining events of the stream.
+
+    Returns
+    -------
+    node : `list`
+        All events of the node, including the first and the closing one.
+    """
+    node = [first]
+    depth = int(isinstance(first, (yaml.MappingStartEvent, yaml.SequenceStartEvent)))
+    while depth:
+        event = next(events)
+        node.append(event)
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+    return node
+
+
+def _node_value(node):
+    """Convert the events of a YAML node to Python objects, ignoring tags,
+    the same way `yaml.BaseLoader` would."""
+    stack, key = [[]], [None]
+    for event in node:
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            container = {} if isinstance(event, yaml.MappingStartEvent) else []
+            stack.append(container)
+            key.append(None)
+            continue
+
+        if isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            value = stack.pop()
+            key.pop()
+        else:
+            value = event.value if isinstance(event, yaml.ScalarEvent) else None
+
+        parent = stack[-1]
+        if isinstance(parent, list):
+            parent.append(value)
+        elif key[-1] is None:
+            key[-1] = value
+        else:
+            parent[key[-1]] = value
+            key[-1] = None
+    return stack[0][0]
+
+
+class _ExportTrimmer:
+    """Filters the event stream of an ``export.yaml`` file created by
+    ``butler export``, see `trim_exported_yaml`.
+
+    Only a single top-level ``data`` entry, or a single record of it, is
+    held in memory at any one time. The filtered events are passed through
+    untouched, so the ``!uuid`` and ``!lsst.daf.butler.Timespan`` tags and
+    the original scalar styles are preserved.
+
+    The ``dataset`` entries must precede the ``associations`` entries, as
+    they do in files written by ``butler export``.
+    """
+    # dimension elements that are kept, the rest is dropped
+    keep_elements = ("instrument", "physical_filter", "detector")
+    # entry types that are kept, the rest is dropped
+    keep_types = ("dimension", "collection", "dataset_type", "dataset", "associations")
+    # keys holding lists of records that are filtered one by one
+    record_keys = ("records", "validity_ranges", "dataset_ids")
+
+    def __init__(self, idxs, fullnames, filters=None):
+        # hashed indexes, so that each record is matched in constant time
+        self.idxs = {int(idx) for idx in idxs}
+        self.fullnames = set(fullnames)
+        self.filters = None if filters is None else set(filters)
+        # flats recognize no filters, biases do but they're both datasets
+        self.datasetFilters = None if filters is None else self.filters | {None}
+        # dataset_id to RUN collection of every kept dataset
+        self.uuids = {}
+        self.seen_associations = False
+        # kept and dropped record counts per entry type
+        self.counts = {}
+
+    @staticmethod
+    def entry_name(entry):
+        """Name of the entry used to report record counts."""
+        if entry["type"] == "dimension":
+            return f"dimension.{entry['element']}"
+        if entry["type"] == "associations":
+            return f"associations.{entry['collection_type']}"
+        return entry["type"]
+
+    def count(self, entry, kept, n=1):
+        """Add ``n`` kept or dropped records of the given entry to the
+        counts."""
+        counts = self.counts.setdefault(self.entry_name(entry), [0, 0])
+        counts[0 if kept else 1] += n
+
+    def keep_record(self, entry, record):
+        """Decide if the record of the given entry is kept and register the
+        IDs of the kept datasets."""
+        kept = self._keep_record(entry, record)
+        self.count(entry, kept)
+        return kept
+
+    def _keep_record(self, entry, record):
+        if entry["type"] == "dimension" and entry["element"] == "detector":
+            return record["full_name"] in self.fullnames
+
+        if entry["type"] == "dimension" and entry["element"] == "physical_filter":
+            return self.filters is None or record["name"] in self.filters
+
+        if entry["type"] == "dataset":
+            if self.seen_associations:
+                raise ValueError("Expected all datasets to precede the associations.")
+            for r in record["data_id"]:
+                if int(r["detector"]) not in self.idxs:
+                    continue
+                if self.filters is None or r.get("physical_filter", None) in self.datasetFilters:
+                    self.uuids.update(dict.fromkeys(record["dataset_id"], entry.get("run")))
+                    return True
+            return False
+
+        # dataset IDs of associations, a scalar or a list of scalars
+        if entry["type"] == "associations":
+            return record in self.uuids
+
+        return True
+
+    def report(self):
+        """Format the kept and dropped record counts as a table."""
+        width = max([len(name) for name in self.counts] + [5])
+        lines = [f"{'entry':{width}}  {'kept':>8}  {'dropped':>8}"]
+        for name, (kept, dropped) in self.counts.items():
+            lines.append(f"{name:{width}}  {kept:8}  {dropped:8}")
+        return "\n".join(lines)
+
+    def trim(self, events):
+        """Yield the events of the trimmed export file."""
+        events = iter(events)
+        # stream and document start, and the top-level mapping
+        for event in events:
+            yield event
+            if isinstance(event, yaml.MappingStartEvent):
+                break
+
+        for event in events:
+            if isinstance(event, yaml.MappingEndEvent):
+                yield event
+                break
+            yield event
+            if event.value != "data":
+                yield from _read_node(next(events), events)
+                continue
+
+            yield next(events)
+            for event in events:
+                if isinstance(event, yaml.SequenceEndEvent):
+                    yield event
+                    break
+                yield from self.trim_entry(event, events)
+
+        # document and stream end
+        yield from events
+
+    def trim_entry(self, first, events):
+        """Yield the events of the trimmed entry of the ``data`` list
+        starting with the given mapping start event."""
+        entry, header = {}, []
+        for event in events:
+            if isinstance(event, yaml.MappingEndEvent) or event.value in self.record_keys:
+                break
+            node = _read_node(next(events), events)
+            entry[event.value] = _node_value(node)
+            header.extend([event] + node)
+
+        keep = entry["type"] in self.keep_types
+        if entry["type"] == "dimension":
+            keep = entry["element"] in self.keep_elements
+        if entry["type"] == "associations":
+            self.seen_associations = True
+
+        if not keep:
+            dropped = 0 if entry["type"] == "dimension" else 1
+            while not isinstance(event, yaml.MappingEndEvent):
+                node = _read_node(next(events), events)
+                if event.value == "records":
+                    dropped = len(_node_value(node) or [])
+                event = next(events)
+            self.count(entry, False, dropped)
+            return
+
+        if entry["type"] not in ("dimension", "dataset", "associations"):
+            self.count(entry, True)
+
+        yield first
+        yield from header
+        while not isinstance(event, yaml.MappingEndEvent):
+            yield event
+            node = next(events)
+            if event.value in self.record_keys:
+                yield from self.trim_records(entry, node, events)
+            else:
+                yield from _read_node(node, events)
+            event = next(events)
+        yield event
+
+    def trim_records(self, entry, first, events):
+        """Yield the events of the sequence of records, starting with the
+        given event, dropping the records that are not kept."""
+        if not isinstance(first, yaml.SequenceStartEvent):
+            yield from _read_node(first, events)
+            return
+
+        yield first
+        for event in events:
+            if isinstance(event, yaml.SequenceEndEvent):
+                yield event
+                return
+
+            # validity ranges are mappings of a timespan and a list of IDs
+            if entry["type"] == "associations" and isinstance(event, yaml.MappingStartEvent):
+                yield event
+                for key in events:
+                    yield key
+                    if isinstance(key, yaml.MappingEndEvent):
+                        break
+                    node = next(events)
+                    if key.value == "dataset_ids":
+                        yield from self.trim_records(entry, node, events)
+                    else:
+                        yield from _read_node(node, events)
+                continue
+
+            node = _read_node(event, events)
+            if self.keep_record(entry, _node_value(node)):
+                yield from node
+
+
+def trim_exported_yaml(path, idxs, fullnames, filters=None, writeto=None, verbose=False):
     """Trim the targeted export.yaml file creted by 
     butler export-calibs, keeping only the targeted 
     CCD names and filter(s).
+
+    The file is trimmed in a single pass over its YAML
+    events, see `_ExportTrimmer`, so it is never loaded
+    in its entirety.
     
     Parameters
     ----------
@@ -196,165 +935,39 @@ def trim_exported_yaml(path, idxs, fullnames, filters=None, writeto=None):
     filters : `list` or `None`
         List of ``physical_filter`` names to preserve.
         These can be simple ugriz characters or longer
-        strings with passband values.
+        strings with passband values. When `None`, all
+        filters are preserved.
     writeto : `str` or `None`
         If provided, path to file where the trimmed YAML will 
         be written.
+    verbose : `bool`
+        Print the number of kept and dropped records per
+        entry type.
 
-    Note
-    ----
-    Don't even try to refactor this function, it's not worth 
-    it. Better to figure out how to do the same 
-    using `~lsst.daf.butler.Butler.export`.
+    Returns
+    -------
+    trimmed : `dict` or `None`
+        The trimmed export, when ``writeto`` is not given.
     """
-    with open(path) as f:
-        export = yaml.load(f, Loader=yaml.BaseLoader)
-        
-    trimmed = {} #OrderedDict()
-    # copy header by hand to preserve key-order and datatypes
-    trimmed["description"] = export["description"]
-    trimmed["version"] = export["version"]
-    trimmed["universe_version"] = int(export["universe_version"])
-    trimmed["universe_namespace"] = export["universe_namespace"]
-    trimmed["data"] = []
-
-    #for key in export.keys():
-    #    if key != "data":
-    #        trimmed[key] = export[key]
-
-    tmpassociations, tmpfilters = [], None
-    uuids, fpaths, existing_filters = [], [], []
-
-    # this for loop occurs over Rubin registry types. There 
-    # are several types: dimension, collection, dataset_type
-    # dataset and associations. 
-    for entry in export["data"]:
-
-        # `dimension` are Rubin abstractions of the physical
-        # characteristic of the observing instrumentation.
-        # Several `dimension`s exist: instrument, detector or 
-        # physical_filter and they list out all of the availible
-        # instruments, detectors or filters that exist at that 
-        # telescope. We skip trimming most of them here because
-        # they don't repeat, are hard to solve, and I don't
-        # think they harm if they exist
-        if entry["type"] == "dimension":
-            elem = entry["element"]
-            if elem == "instrument":
-                trimmed["data"].append(entry)
-
-            if elem == "physical_filter":
-                tmpfilters = entry
-                trimmed["data"].append(entry)
-
-            if elem == "detector":
-                tmprows = []
-                for row in entry["records"]:
-                    if row["full_name"] in fullnames:
-                        tmprows.append(row)
-                trimmed["data"].append(entry)
-                trimmed["data"][-1]["records"] = tmprows
-
-        # Collections and dataset_types are Rubin abstractions
-        # of data collections of data and of different "kinds"
-        # of images (raw, bias, flat, calexp etc.) and other
-        # datasets (defects etc.). We want to keep this in 
-        # its entirety, doing otherwise leaves the data repo
-        # in an inconsistent state.
-        if entry["type"] in ["collection", "dataset_type"]:
-            trimmed["data"].append(entry)
-
-        # Associations basically list which dataids belong to
-        # which collection, but we don't know the order of 
-        # items in the export["data"] list, so we have to
-        # skip rewriting the associations until we find all
-        # dataids that we're actually keeping. Unlike
-        # dimensions, associations can repeat for any N 
-        # collections we have.
-        if entry["type"] == "associations":
-            tmpassociations.append(entry)
-            trimmed["data"].append(entry)
+    trimmer = _ExportTrimmer(idxs, fullnames, filters)
+    # the C parser, when available, is considerably faster
+    Loader = getattr(yaml, "CBaseLoader", yaml.BaseLoader)
 
-        # Finally, dataset type is the one we want to trim
-        # datasets oddly can have multiple instrument-detector-filter
-        # pairs at the same time?
-        if entry["type"] == "dataset":
-            tmprows = []
-            for row in entry["records"]:
-                tmpr = []
-                for r in row["data_id"]:
-                    # flats recognize no filtrs, biases do but they're both datasets
-                    rHasFilter = r.get("physical_filter",  False)
-                    if rHasFilter and int(r["detector"]) in idxs and r["physical_filter"] in filters:
-                        add = True
-                    elif rHasFilter and int(r["detector"]) in idxs and r["physical_filter"] not in filters:
-                        add = False
-                    elif not rHasFilter and int(r["detector"]) in idxs:
-                        add=True
-                    else:
-                        add = False
-
-                    #datType = entry.get("dataset_type", False)
-                    #if datType == "bias":
-                        #breakpoint()
-                    if add:
-                        tmpr.append(row)
-                        uuids.extend(row["dataset_id"])
-                        existing_filters.extend([di["physical_filter"] for di in row["data_id"] if "physical_filter" in di])
-                if tmpr:
-                    tmprows.extend(tmpr)
-            trimmed["data"].append(entry)
-            trimmed["data"][-1]["records"] = tmprows
-
-    # we added things to the trimmed copy even when we
-    # couldn't trim them at the time to preserve the 
-    # ordering in the YAML. Time to revisit these.
-    uuids = set(uuids)
-    filters = set(filters)
-    keep_filters = filters if filters is not None else existing_filters
-    for i, entry in enumerate(trimmed["data"]):
-        if entry["type"] == "dimension" and entry["element"] == "physical_filter":
-            newrecords = []
-            for row in entry["records"]:
-                if row["name"] in keep_filters:
-                    newrecords.append(row)
-            trimmed["data"][i]["records"] = newrecords
-
-        if entry["type"] == "associations":
-            matching_assoc, j = None, 0
-            for assoc in tmpassociations:
-                if assoc == entry:
-                    matching_assoc = assoc
-                    j += 1
-            
-            if j>1:
-                raise ValueError("Identified multiple associations as matching!")
-            
-            keepvalrange = []
-            for valrange in matching_assoc["validity_ranges"]:
-                keepvalrange.append({"timespan": valrange["timespan"]})
-                keepvalrange[-1]["dataset_ids"] = []
-                for did in valrange["dataset_ids"]:
-                    if did in uuids:
-                        keepvalrange[-1]["dataset_ids"].append(did)
-            if keepvalrange:
-                trimmed["data"][i]["validity_ranges"] = keepvalrange
-            else:
-                trimmed["data"][i]["validity_ranges"] = None
+    with open(path) as f:
+        events = trimmer.trim(yaml.parse(f, Loader=Loader))
+        if writeto is not None:
+            with open(writeto, "w") as out:
+                yaml.emit(events, out)
+        else:
+            trimmedYaml = yaml.emit(events)
 
-    trimmedYaml = yaml.dump(trimmed, default_flow_style=False, sort_keys=False)
-    trimmedYaml = trimmedYaml.replace("'", "")
-    # important to include newline char in case one timespan passed with the class
-    # descriptor
-    trimmedYaml = trimmedYaml.replace("timespan:\n", "timespan: !lsst.daf.butler.Timespan\n")
-    for did in uuids:
-        trimmedYaml = trimmedYaml.replace(did, f"!uuid '{did}'")
+    if verbose:
+        print(trimmer.report())
 
     if writeto is not None:
-        with open(writeto, "w") as f:
-            f.write(trimmedYaml)
-    else:
-        return trimmed
+        return
+
+    return yaml.load(trimmedYaml, Loader=yaml.BaseLoader)
 
 
 def compress_image(path, protected, **kwargs):
@@ -389,14 +1002,15 @@ def compress_image(path, protected, **kwargs):
 
     # be careful about discerning the name of the detectors from its 
     # associated logical id and its index in the HDUList object
-    hdumap = HDULookup.fromDECamHDUList(hdul)
-    protected_names = hdumap.to_names(protected)
-    protected_idxs = [hdul.index_of(idx) for idx in protected_names]
+    hdumap = HDULookup.fromDECamHDUList(hdul, HDU_LAYOUTS, protected)
+    protected_idxs = set(hdumap.to_positions(protected))
 
-    imagelike_idxs = [hdul.index_of(n) for n in hdumap.get_imagelike_names()]
+    imagelike_idxs = hdumap.get_imagelike_positions()
     for idx in imagelike_idxs:
         if idx not in protected_idxs:
-            hdul[idx].data[:] = 0
+            # zeroed data is never read, see compressed_zeros_from_header
+            hdul[idx] = compressed_zeros_from_header(hdul[idx].header, **kwargs)
+            continue
 
         # this compresses the protected data too, it 
         # just doesn't set them identically to 0
@@ -409,11 +1023,211 @@ def compress_image(path, protected, **kwargs):
     return hdul
 
 
-def compress_images(loadfrom, writeto, protectHDUs, verbose=False, overwrite=False, **kwargs):
+def resolve_output_path(path, writeto):
+    """Resolve the location the trimmed copy of the file will be written to.
+
+    The name is always derived from the input file, never from the order in
+    which the files were processed, so serial and parallel runs produce
+    identical outputs.
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the input FITS file.
+    writeto : `str`
+        Path to the output directory, or the output file.
+
+    Returns
+    -------
+    fpath : `str`
+        Path to the output file.
+    """
+    if os.path.isdir(writeto):
+        return os.path.join(writeto, os.path.basename(path))
+    # likely a single exposure only
+    return writeto
+
+
+def trim_image(path, fpath, protected, overwrite=False, **kwargs):
+    """Trim a single file and write it to the given location.
+
+    Unit of work of `compress_images`. The trimmed HDUList is written from
+    within the call so that, when ran in a worker process, only the path
+    travels back to the parent process and not the pixel data.
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the file to process.
+    fpath : `str`
+        Path to where the trimmed file will be written to.
+    protected : `int` or `list`
+        ID(s) of the HDU to leave unchanged.
+    overwrite : `bool`
+        Overwrite the file at the destination, if it exists.
+    kwargs : `dict`
+        Optional `fits.CompImageHDU` init parameters.
+
+    Returns
+    -------
+    fpath : `str`
+        Path to the written file.
+    """
+    with compress_image(path, protected, **kwargs) as newimg:
+        newimg.writeto(fpath, overwrite=overwrite)
+    return fpath
+
+
+def trim_image_streaming(path, fpath, protected, overwrite=False, **kwargs):
+    """Trim a single file and write it to the given location one HDU at
+    a time.
+
+    Produces the same output as `trim_image`, but only a single HDU is ever
+    held in memory. Unprotected image-like HDUs are replaced by compressed
+    zeros created from their headers, so their data is never read or
+    decompressed. Only the protected HDUs are decompressed and recompressed.
+
+    Parameters
+    ----------
+    path : `str`
+        Path to the file to process.
+    fpath : `str`
+        Path to where the trimmed file will be written to.
+    protected : `int` or `list`
+        ID(s) of the HDU to leave unchanged.
+    overwrite : `bool`
+        Overwrite the file at the destination, if it exists.
+    kwargs : `dict`
+        Optional `fits.CompImageHDU` init parameters.
+
+    Returns
+    -------
+    fpath : `str`
+        Path to the written file.
+    """
+    if not os.path.isfile(path):
+        raise ValueError(f"Expected path to file, got {path} instead.")
+
+    # fits.open does not take the overwrite argument in the ostream mode
+    if not overwrite and os.path.exists(fpath):
+        raise OSError(f"File {fpath} already exists, use overwrite to replace it.")
+
+    # the output is written to a temporary file first so that a failure does
+    # not leave a partial file behind and so that files can be trimmed in place
+    tmppath = f"{fpath}.part"
+    try:
+        # not memory mapped, the mapped pages of every read HDU would otherwise
+        # stay resident until the file is closed
+        with fits.open(path, lazy_load_hdus=True, memmap=False) as hdul, \
+             open(tmppath, "wb") as outfile, \
+             fits.open(outfile, mode="ostream") as out:
+            hdumap = HDULookup.fromDECamHDUList(hdul, HDU_LAYOUTS, protected)
+            protected_idxs = set(hdumap.to_positions(protected))
+
+            for idx, hdu in enumerate(hdul):
+                if "ImageHDU" not in hdu.__class__.__name__:
+                    newhdu = hdu
+                elif idx in protected_idxs:
+                    newhdu = fits.CompImageHDU(header=fits.Header(hdu.header), data=hdu.data, **kwargs)
+                else:
+                    newhdu = compressed_zeros_from_header(hdu.header, **kwargs)
+
+                out.append(newhdu)
+                out.flush()
+
+                # release the pixels, written HDUs are not revisited
+                if newhdu is not hdu:
+                    del newhdu.data
+                del hdu.data
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+    os.replace(tmppath, fpath)
+    return fpath
+
+
+def trim_and_record(trimmer, path, fpath, protected, overwrite=False, **kwargs):
+    """Trim a single file with the given trimmer and describe its input and
+    output, see `file_record`.
+
+    The input is described before it is trimmed, as it might be overwritten
+    by the output.
+
+    Returns
+    -------
+    records : `tuple`
+        Records of the input and the output files.
+    """
+    input_record = file_record(path)
+    trimmer(path, fpath, protected, overwrite, **kwargs)
+    return input_record, file_record(fpath)
+
+
+def _run_serial(trimmer, tasks, protectHDUs, **kwargs):
+    """Yield ``(path, fpath, result, error)`` for each ``(path, fpath,
+    overwrite)`` task, processed one by one."""
+    for path, fpath, overwrite in tasks:
+        try:
+            result = trimmer(path, fpath, protectHDUs, overwrite, **kwargs)
+        except Exception as e:
+            yield path, fpath, None, e
+        else:
+            yield path, fpath, result, None
+
+
+def _init_worker(layouts):
+    """Share the parent's HDU layouts with the worker process."""
+    HDU_LAYOUTS.update({k: HDULookup.fromDict(v) for k, v in layouts.items()})
+
+
+def _run_parallel(trimmer, tasks, protectHDUs, jobs, **kwargs):
+    """Yield ``(path, fpath, result, error)`` for each ``(path, fpath,
+    overwrite)`` task, processed by a pool of ``jobs`` worker processes.
+
+    At most ``2*jobs`` files are submitted to the pool at any one time, which
+    bounds the number of exposures held in memory regardless of the number of
+    files being processed. Results are yielded in the order of completion.
+    A worker dying breaks the pool, the files that were not trimmed by then
+    fail with a `BrokenProcessPool` error.
+    """
+    tasks = iter(tasks)
+    nSubmit = 2*jobs
+    layouts = {k: v.toDict() for k, v in HDU_LAYOUTS.items()}
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(layouts, )) as pool:
+        inFlight = {}
+        while True:
+            for path, fpath, overwrite in itertools.islice(tasks, nSubmit):
+                try:
+                    future = pool.submit(trimmer, path, fpath, protectHDUs, overwrite, **kwargs)
+                except BrokenProcessPool as e:
+                    yield path, fpath, None, e
+                    for path, fpath, _ in tasks:
+                        yield path, fpath, None, e
+                    break
+                inFlight[future] = (path, fpath)
+
+            if not inFlight:
+                break
+
+            done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, fpath = inFlight.pop(future)
+                error = future.exception()
+                yield path, fpath, None if error else future.result(), error
+            nSubmit = len(done)
+
+
+def compress_images(loadfrom, writeto, protectHDUs, verbose=False, overwrite=False, jobs=1,
+                    stream=False, incremental=False, layouts=None, **kwargs):
     """Zeroes out all but the selected HDU(s) and compresses
     the files using fpack or Astropy's CompHDU for all found
     FITS files and saves them in the given location.
 
+    A failure to process any single file is reported, but does
+    not interrupt the processing of the remaining files.
+
     Parameters
     ----------
     loadfrom : `str`
@@ -422,39 +1236,321 @@ def compress_images(loadfrom, writeto, protectHDUs, verbose=False, overwrite=Fal
         Path to the directory in which the files will be saved.
     protectHDUs : `int` or `list`
         ID(s) of the HDU to leave unchanged.
+    verbose : `bool`
+        Print processing progress.
+    overwrite : `bool`
+        Overwrite files at the destination, if they exist.
+    jobs : `int`
+        Number of worker processes to use. When 1, the files
+        are processed serially in the calling process.
+    stream : `bool`
+        Trim the files one HDU at a time, see `trim_image_streaming`.
+    incremental : `bool`
+        Skip the files that were trimmed before with the same parameters
+        and did not change since, see `TrimManifest`. Outdated previously
+        trimmed files are overwritten.
+    layouts : `str` or `None`
+        Path to a JSON file of cached HDU layouts, see `HDU_LAYOUTS`.
+        Loaded, if it exists, and updated with new layouts at the end.
     kwargs : `dict`
         Optional `fits.CompImageHDU` init parameters that will be
         passed on, if the selected compression strategy is ``astropy``. 
+
+    Returns
+    -------
+    summary : `dict`
+        Lists of ``written`` and ``skipped`` output file paths and of
+        ``failed`` ``(input path, error message)`` pairs.
     """
     if os.path.isfile(loadfrom):
         files = [loadfrom, ]
     elif os.path.isdir(loadfrom):
-        files = glob.glob(f"{loadfrom}/*.fits*")
+        files = sorted(glob.glob(f"{loadfrom}/*.fits*"))
     else:
         raise ValueError("Expected path to file or a directory, got {loadfrom} instead.")
 
     if os.path.isdir(writeto) and not os.path.exists(writeto):
         os.makedirs(writeto, exist_ok=True)
 
-    totn = len(files)
-    for i, f in enumerate(files):
-        newimg = compress_image(f, protectHDUs, **kwargs)
-        if os.path.isdir(writeto):
-            dn = newimg.filename()
-            fn = os.path.basename(dn) if os.sep in dn else dn
-            fpath = os.path.join(writeto, fn)
-        else:
-            # likely a single exposure only
-            fpath = writeto
-        newimg.writeto(fpath, overwrite=overwrite)
+    trimmer = trim_image_streaming if stream else trim_image
+    tasks = [(f, resolve_output_path(f, writeto), overwrite) for f in files]
+    totn = len(tasks)
+    summary = {"written": [], "skipped": [], "failed": []}
+
+    if incremental:
+        outdir = writeto if os.path.isdir(writeto) else os.path.dirname(os.path.abspath(writeto))
+        manifest = TrimManifest.fromDirectory(outdir)
+        params = TrimManifest.params_digest(protectHDUs, **kwargs)
+        outdated = []
+        for path, fpath, _ in tasks:
+            if manifest.is_current(path, fpath, params):
+                summary["skipped"].append(fpath)
+            else:
+                # previously trimmed, but outdated, files are always overwritten
+                known = os.path.basename(fpath) in manifest.entries
+                outdated.append((path, fpath, overwrite or known))
+        tasks = outdated
+        trimmer = functools.partial(trim_and_record, trimmer)
         if verbose:
-            print(f"[{i}/{totn}] Writing {fpath} succesfull.")
+            print(f"Skipping {len(summary['skipped'])}/{totn} up to date files.")
+
+    load_hdu_layouts(layouts)
+    if jobs > 1:
+        # resolve the layout once, from the headers only, instead of per worker
+        # workers resolve it themselves, and report the error, if this fails
+        if tasks:
+            try:
+                HDULookup.fromDECamFile(tasks[0][0], HDU_LAYOUTS)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Could not resolve the HDU layout of {tasks[0][0]}: {e}")
+        results = _run_parallel(trimmer, tasks, protectHDUs, jobs, **kwargs)
+    else:
+        results = _run_serial(trimmer, tasks, protectHDUs, **kwargs)
+
+    try:
+        for i, (path, fpath, result, error) in enumerate(results, len(summary["skipped"])):
+            if error is None:
+                summary["written"].append(fpath)
+                if incremental:
+                    manifest.update(fpath, params, *result)
+                if verbose:
+                    print(f"[{i+1}/{totn}] Writing {fpath} succesfull.")
+            else:
+                summary["failed"].append((path, f"{type(error).__name__}: {error}"))
+                if verbose:
+                    print(f"[{i+1}/{totn}] Processing {path} FAILED: {error}")
+    finally:
+        # record the progress even if interrupted
+        if incremental:
+            manifest.save()
+        if layouts is not None:
+            save_hdu_layouts(layouts)
+
+    if verbose or summary["failed"]:
+        print(f"Trimmed {len(summary['written'])}/{totn} files, {len(summary['skipped'])} skipped, "
+              f"{len(summary['failed'])} failed.")
+        for path, msg in summary["failed"]:
+            print(f"    {path}: {msg}")
+
+    return summary
+
+
+class TrimPipeline:
+    """Trims files on a pool of worker processes as they are produced, for
+    example as they are downloaded, so that producing and trimming overlap.
+
+    Files are submitted with `put`, which blocks while ``maxQueued`` files
+    are already waiting to be trimmed. Call `close` to wait for the queued
+    files to be trimmed and get the processing summary, or use the pipeline
+    as a context manager. A failure to trim any single file is recorded in
+    the summary and does not stop the pipeline. Should the pipeline itself
+    fail, `put` raises instead of blocking.
+
+    Parameters
+    ----------
+    protectHDUs : `int` or `list`
+        ID(s) of the HDU to leave unchanged.
+    jobs : `int`
+        Number of worker processes.
+    maxQueued : `int` or `None`
+        Maximum number of files waiting to be trimmed, ``2*jobs`` by default.
+    verbose : `bool`
+        Print processing progress.
+    overwrite : `bool`
+        Overwrite files at the destination, if they exist.
+    stream : `bool`
+        Trim the files one HDU at a time, see `trim_image_streaming`.
+    incremental : `bool`
+        Skip the files that are up to date, see `TrimManifest`. Each
+        output directory keeps its own manifest.
+    layouts : `str` or `None`
+        Path to a JSON file of cached HDU layouts, see `HDU_LAYOUTS`.
+    kwargs : `dict`
+        Optional `fits.CompImageHDU` init parameters.
+    """
+    def __init__(self, protectHDUs, jobs=1, maxQueued=None, verbose=False, overwrite=False,
+                 stream=False, incremental=False, layouts=None, **kwargs):
+        self.protectHDUs = protectHDUs
+        self.jobs = max(1, jobs)
+        self.verbose = verbose
+        self.overwrite = overwrite
+        self.incremental = incremental
+        self.layouts = layouts
+        self.kwargs = kwargs
+        self.trimmer = trim_image_streaming if stream else trim_image
+        if incremental:
+            self.trimmer = functools.partial(trim_and_record, self.trimmer)
+        self.params = TrimManifest.params_digest(protectHDUs, **kwargs)
+        self.manifests = {}
+        self.summary = {"written": [], "skipped": [], "failed": []}
+        self.queue = queue.Queue(maxsize=2*self.jobs if maxQueued is None else maxQueued)
+        self.thread = None
+        # the error that stopped the trimming thread, if any
+        self.error = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """Start trimming the submitted files."""
+        load_hdu_layouts(self.layouts)
+        self.thread = threading.Thread(target=self._consume, daemon=True)
+        self.thread.start()
+
+    def _enqueue(self, item):
+        # blocks while the queue is full, but only as long as there is a
+        # thread that will eventually take the item off of it
+        while True:
+            if self.thread is None or not self.thread.is_alive():
+                raise RuntimeError(f"The trimming pipeline is not running: {self.error}")
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def put(self, path, fpath):
+        """Submit the file at ``path`` to be trimmed and written to ``fpath``,
+        blocking while the queue is full.
+
+        Raises
+        ------
+        RuntimeError
+            When the pipeline is not running.
+        """
+        self._enqueue((path, fpath))
+
+    def close(self):
+        """Wait for all the submitted files to be trimmed.
+
+        Files that were still queued when the pipeline failed are reported
+        as failed.
+
+        Returns
+        -------
+        summary : `dict`
+            Processing summary, see `compress_images`.
+        """
+        if self.thread is not None:
+            try:
+                self._enqueue(None)
+            except RuntimeError:
+                pass
+            self.thread.join()
+            self.thread = None
+
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item:
+                    self.summary["failed"].append((item[0], f"Not trimmed, pipeline failed: {self.error}"))
+
+        if self.verbose or self.summary["failed"]:
+            nfiles = sum(len(v) for v in self.summary.values())
+            print(f"Trimmed {len(self.summary['written'])}/{nfiles} files, "
+                  f"{len(self.summary['skipped'])} skipped, {len(self.summary['failed'])} failed.")
+            for path, msg in self.summary["failed"]:
+                print(f"    {path}: {msg}")
+        return self.summary
+
+    def _manifest(self, fpath):
+        outdir = os.path.dirname(os.path.abspath(fpath))
+        if outdir not in self.manifests:
+            self.manifests[outdir] = TrimManifest.fromDirectory(outdir)
+        return self.manifests[outdir]
+
+    def _task(self, path, fpath):
+        """Return the ``(path, fpath, overwrite)`` task of the file, or `None`
+        when it is up to date."""
+        os.makedirs(os.path.dirname(os.path.abspath(fpath)), exist_ok=True)
+        if not self.incremental:
+            return path, fpath, self.overwrite
+
+        manifest = self._manifest(fpath)
+        if manifest.is_current(path, fpath, self.params):
+            self.summary["skipped"].append(fpath)
+            if self.verbose:
+                print(f"Skipping up to date {fpath}.")
+            return None
+        # previously trimmed, but outdated, files are always overwritten
+        return path, fpath, self.overwrite or os.path.basename(fpath) in manifest.entries
+
+    def _submit(self, pool, inFlight, path, fpath):
+        # errors are recorded, not raised, so that the thread keeps
+        # consuming the queue and the producers are never blocked
+        try:
+            task = self._task(path, fpath)
+            if task is not None:
+                path, fpath, overwrite = task
+                future = pool.submit(self.trimmer, path, fpath, self.protectHDUs,
+                                     overwrite, **self.kwargs)
+                inFlight[future] = (path, fpath)
+        except Exception as e:
+            self._record(path, fpath, None, e)
+
+    def _record(self, path, fpath, result, error):
+        if error is None:
+            if self.incremental:
+                manifest = self._manifest(fpath)
+                manifest.update(fpath, self.params, *result)
+                manifest.save()
+            self.summary["written"].append(fpath)
+            if self.verbose:
+                print(f"Writing {fpath} succesfull.")
+        else:
+            self.summary["failed"].append((path, f"{type(error).__name__}: {error}"))
+            if self.verbose:
+                print(f"Processing {path} FAILED: {error}")
+
+    def _consume(self):
+        # Workers are spawned, not forked, because the producers are usually
+        # threads of the same process that may hold locks at any time.
+        layouts = {k: v.toDict() for k, v in HDU_LAYOUTS.items()}
+        context = multiprocessing.get_context("spawn")
+        closed, inFlight = False, {}
+        try:
+            with ProcessPoolExecutor(max_workers=self.jobs, mp_context=context,
+                                     initializer=_init_worker, initargs=(layouts, )) as pool:
+                while not closed or inFlight:
+                    # take more files only while there are idle workers
+                    if not closed and len(inFlight) < self.jobs:
+                        try:
+                            item = self.queue.get(timeout=0.1 if inFlight else None)
+                        except queue.Empty:
+                            item = False
+                        if item is None:
+                            closed = True
+                        elif item:
+                            self._submit(pool, inFlight, *item)
+
+                    busy = closed or len(inFlight) >= self.jobs
+                    done, _ = wait(inFlight, timeout=None if busy else 0, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        path, fpath = inFlight.pop(future)
+                        error = future.exception()
+                        try:
+                            self._record(path, fpath, None if error else future.result(), error)
+                        except Exception as e:
+                            self._record(path, fpath, None, e)
+        except BaseException as e:
+            self.error = e
+            raise
+        finally:
+            if self.layouts is not None:
+                save_hdu_layouts(self.layouts)
 
 
 ############################################################
 #                         Main
 ############################################################
-def main(path, hdus, writeto=False, verbose=False, overwrite=False, **kwargs):
+def main(path, hdus, writeto=False, verbose=False, overwrite=False, jobs=1, stream=False,
+         incremental=False, layouts=None, **kwargs):
     """Zeroes out all but the selected HDU(s) and, optionally,
     compresses the files using fpack or Astropy's CompHDU.
 
@@ -471,21 +1567,35 @@ def main(path, hdus, writeto=False, verbose=False, overwrite=False, **kwargs):
         If a path is given, writes the compressed files to that
         location. Otherwise the compressed fits are returned as
         a list of `fits.HDUList` objects.
+    jobs : `int`
+        Number of worker processes to use.
+    stream : `bool`
+        Read and write the files one HDU at a time.
+    incremental : `bool`
+        Trim only the new or changed files.
+    layouts : `str` or `None`
+        Path to the JSON file caching the HDU layouts.
     kwargs : `dict`
         Optional `fits.CompImageHDU` init parameters that will be
         passed on, if the selected compression strategy is ``astropy``. 
+
+    Returns
+    -------
+    summary : `dict`
+        Processing summary, see `compress_images`.
     """
-    res = compress_images(
+    return compress_images(
         loadfrom=path,
         writeto=writeto,
         protectHDUs=hdus,
         verbose=verbose,
         overwrite=overwrite,
+        jobs=jobs,
+        stream=stream,
+        incremental=incremental,
+        layouts=layouts,
         **kwargs
     )
-
-    if res is not None:
-        return new_fits
                       
 
 if __name__=="__main__":
@@ -540,6 +1650,36 @@ if __name__=="__main__":
         help="Overwrite files at the destination, if they exist..",
         action="store_true", dest="overwrite"
     )
+    parser.add_argument(
+        "--jobs", "-j",
+        help="Number of worker processes used to trim the files. Default: 1",
+        type=int, default=1, dest="jobs"
+    )
+    parser.add_argument(
+        "--stream",
+        help=(
+            "Process the files one HDU at a time, never decompressing the zeroed "
+            "detectors. Lowers the peak memory use to a single detector."
+        ),
+        action="store_true", dest="stream"
+    )
+    parser.add_argument(
+        "--incremental",
+        help=(
+            "Skip files that were already trimmed with the same detectors and compression "
+            "parameters and did not change since. Progress is recorded in a manifest file "
+            "at the destination."
+        ),
+        action="store_true", dest="incremental"
+    )
+    parser.add_argument(
+        "--hdu-layouts",
+        help=(
+            "JSON file in which the detector maps of the seen instrument layouts are "
+            "cached between the runs. Created if it does not exist."
+        ),
+        nargs="?", default=None, dest="layouts"
+    )
 
     ##########
     # Logic
@@ -561,17 +1701,24 @@ if __name__=="__main__":
             # strings, so we make the guess here
             try:
                 val = float(v)
-            except TypeError:
+            except ValueError:
                 val = v
             kwargs[key] = val
 
     hdus = [i for i in aargs.hdus.split(",")]
 
-    main(
+    summary = main(
         path=aargs.path,
         hdus=hdus,
         writeto=aargs.writeto,
         verbose=aargs.verbose,
         overwrite=aargs.overwrite,
+        jobs=aargs.jobs,
+        stream=aargs.stream,
+        incremental=aargs.incremental,
+        layouts=aargs.layouts,
         **kwargs
     )
+
+    if summary["failed"]:
+        sys.exit(1)
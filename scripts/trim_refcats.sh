@@ -7,15 +7,20 @@ SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 # Cleanup existing directories and create a fresh one
 rm -rf $SCRIPT_DIR/../trimmedRefcats
 
+# Both catalogs use HTM depth 7 shards, so the exposures are resolved once
+# and the second catalog, and any later run, reads the shards from the index
+SHARD_INDEX=${XDG_CACHE_HOME:-$HOME/.cache}/kbmod_imdiff_recipe/shard_index.sqlite
 
-python %SCRIPT_DIR/refcat_shard_resolver.py $SCRIPT_DIR/../trimmedRawData/210318/science/ \
+python $SCRIPT_DIR/refcat_shard_resolver.py $SCRIPT_DIR/../trimmedRawData/210318/science/ \
        --refcat ps1_pv3_3pi_20170110 \
        --refcat-path /epyc/data/lsst_refcats/ps1/ps1_pv3_3pi_20170110 \
+       --index $SHARD_INDEX \
        --copy \
        --import-file
 
 python $SCRIPT_DIR/refcat_shard_resolver.py $SCRIPT_DIR/../trimmedRawData/210318/science/ \
        --refcat gaia_dr3_20230707 \
        --refcat-path /epyc/data/lsst_refcats/GAIA_DR3/gaia_dr3 \
+       --index $SHARD_INDEX \
        --copy \
        --import-file
@@ -0,0 +1,161 @@
+import os
+import sys
+import hashlib
+import tempfile
+import threading
+import unittest
+import http.server
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from download_data import Downloader  # noqa: E402
+
+
+class ArchiveStandIn(http.server.BaseHTTPRequestHandler):
+    # Serves `files`, keyed by their md5sum, the way the archive's retrieve
+    # endpoint does, honouring single open-ended range requests unless
+    # `ranges` is disabled. Every request is logged in `requests`.
+    files = {}
+    ranges = True
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        md5 = self.path.strip("/")
+        rangeHeader = self.headers.get("Range")
+        self.requests.append((md5, rangeHeader))
+        if md5 not in self.files:
+            self.send_error(404)
+            return
+
+        data, start = self.files[md5], 0
+        if self.ranges and rangeHeader is not None:
+            start = int(rangeHeader.removeprefix("bytes=").rstrip("-"))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+class TestDownloadTo(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ArchiveStandIn)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+        class LocalDownloader(Downloader):
+            download_url = f"http://127.0.0.1:{cls.server.server_address[1]}/{{}}"
+            chunk_size = 2**12
+        cls.Downloader = LocalDownloader
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dirpath = self.tmpdir.name
+        self.data = np.random.default_rng(42).bytes(100_000)
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        ArchiveStandIn.files = {self.md5: self.data}
+        ArchiveStandIn.ranges = True
+        ArchiveStandIn.requests = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def downloader(self, md5=None):
+        return self.Downloader.fromColumns({
+            "md5sum": np.array([self.md5 if md5 is None else md5]),
+            "archive_filename": np.array(["/archive/c4d_210319_000000_ori.fits.fz"]),
+        })
+
+    @property
+    def fpath(self):
+        return os.path.join(self.dirpath, "c4d_210319_000000_ori.fits.fz")
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def testDownload(self):
+        failed = self.downloader().downloadTo(self.dirpath, jobs=1)
+        self.assertEqual(failed, [])
+        self.assertEqual(self.read(self.fpath), self.data)
+        self.assertFalse(os.path.exists(f"{self.fpath}.part"))
+        self.assertEqual(ArchiveStandIn.requests, [(self.md5, None)])
+
+    def testResumeInterruptedPart(self):
+        with open(f"{self.fpath}.part", "wb") as f:
+            f.write(self.data[:40_000])
+
+        failed = self.downloader().downloadTo(self.dirpath, jobs=1)
+        self.assertEqual(failed, [])
+        self.assertEqual(self.read(self.fpath), self.data)
+        self.assertFalse(os.path.exists(f"{self.fpath}.part"))
+        # only the missing bytes were requested
+        self.assertEqual(ArchiveStandIn.requests, [(self.md5, "bytes=40000-")])
+
+    def testCompletePart(self):
+        with open(f"{self.fpath}.part", "wb") as f:
+            f.write(self.data)
+
+        failed = self.downloader().downloadTo(self.dirpath, jobs=1)
+        self.assertEqual(failed, [])
+        self.assertEqual(self.read(self.fpath), self.data)
+        self.assertEqual(ArchiveStandIn.requests, [(self.md5, "bytes=100000-")])
+
+    def testResumeWithoutRangeSupport(self):
+        ArchiveStandIn.ranges = False
+        with open(f"{self.fpath}.part", "wb") as f:
+            f.write(self.data[:40_000])
+
+        failed = self.downloader().downloadTo(self.dirpath, jobs=1)
+        self.assertEqual(failed, [])
+        self.assertEqual(self.read(self.fpath), self.data)
+
+    def testChecksumMismatch(self):
+        # the archive md5sum does not match the served content
+        wrongMd5 = "0"*32
+        ArchiveStandIn.files = {wrongMd5: self.data}
+
+        failed = self.downloader(wrongMd5).downloadTo(self.dirpath, jobs=1)
+        self.assertEqual(len(failed), 1)
+        self.assertFalse(os.path.exists(self.fpath))
+        # a corrupted part is not resumed by the next attempt
+        self.assertFalse(os.path.exists(f"{self.fpath}.part"))
+
+    def testSkipVerified(self):
+        with open(self.fpath, "wb") as f:
+            f.write(self.data)
+
+        completed = []
+        failed = self.downloader().downloadTo(self.dirpath, jobs=1, onComplete=completed.append)
+        self.assertEqual(failed, [])
+        self.assertEqual(ArchiveStandIn.requests, [])
+        self.assertEqual(completed, [self.fpath])
+
+    def testReplaceUnverified(self):
+        with open(self.fpath, "wb") as f:
+            f.write(self.data[:1000])
+
+        failed = self.downloader().downloadTo(self.dirpath, jobs=1)
+        self.assertEqual(failed, [])
+        self.assertEqual(self.read(self.fpath), self.data)
+        self.assertEqual(ArchiveStandIn.requests, [(self.md5, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()